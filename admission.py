@@ -0,0 +1,140 @@
+# admission.py
+
+import logging
+import time
+from functools import wraps
+
+from flask import request
+from flask_socketio import emit
+
+log = logging.getLogger('ss.admission')
+
+
+# トークンバケット: 1秒あたり rate 個のトークンが burst 個まで溜まり、イベントごとに1個使う
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.updated = now
+
+    # トークンを1個使う。足りなければ使わずに、次のトークンが溜まるまでの秒数を返す
+    def take(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+# キー（SID、ルームID）ごとのトークンバケット
+class RateLimiter:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+
+    # 許可する場合は 0、制限する場合は再送までの秒数を返す（rate が 0 以下なら制限しない）
+    def check(self, key, now=None):
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+        return bucket.take(self.rate, self.burst, now)
+
+    def discard(self, key):
+        self._buckets.pop(key, None)
+
+    def keys(self):
+        return list(self._buckets)
+
+    # トークンが満タンに戻ったバケットを削除する（片付け用。次のイベントで作り直しても結果は同じ）
+    def prune(self, keys, now=None):
+        now = time.monotonic() if now is None else now
+        removed = 0
+        for key in keys:
+            bucket = self._buckets.get(key)
+            if bucket is not None and bucket.tokens + (now - bucket.updated) * self.rate >= self.burst:
+                del self._buckets[key]
+                removed += 1
+        return removed
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# Socket.IO イベントの受け付け制御
+# ・SIDごと、ルームごとにトークンバケットで頻度を制限する
+#   ルームのバケットは、そのルームに参加済み（room_of(SID) がそのルーム）の接続のイベントだけに数える
+#   （クライアントが送ってきたルームIDをそのまま使うと、他人のルームのバケットを使い切れてしまうため）
+# ・処理中のイベント数、またはルームのロックの待ち時間が上限を超えたら、新しい処理（めくる、参加）を断る
+#   （離脱・切断は断らない）
+# ・断った場合は 'error' に code と retry_after（秒）を付けて返す
+class AdmissionControl:
+    def __init__(self, metrics, sid_rate=10.0, sid_burst=20, room_rate=30.0, room_burst=60,
+                 max_in_flight=200, max_lock_wait=0.05, shed_retry_after=1.0, room_of=None):
+        self.metrics = metrics
+        self.room_of = room_of  # room_of(SID): その接続が参加しているルームID（未参加なら None）
+        self.sids = RateLimiter(sid_rate, sid_burst)
+        self.rooms = RateLimiter(room_rate, room_burst)
+        self.max_in_flight = max_in_flight
+        self.max_lock_wait = max_lock_wait
+        self.shed_retry_after = shed_retry_after
+        # メトリクス
+        self.rejected = {}  # (イベント名, 理由) -> 件数
+
+    # 過負荷なら理由を返す
+    def overloaded(self):
+        if self.max_in_flight and self.metrics.events_in_flight > self.max_in_flight:
+            return 'overloaded'
+        if self.max_lock_wait and self.metrics.lock_wait_avg > self.max_lock_wait:
+            return 'overloaded'
+        return None
+
+    # 受け付けない場合は (理由, 再送までの秒数) を返す
+    # room_id はイベントで指定されたルーム。SIDがそのルームに参加済みの場合だけルームのバケットを使う
+    def admit(self, sid, room_id, shed=True):
+        now = time.monotonic()
+        if shed and self.overloaded():
+            return 'overloaded', self.shed_retry_after
+        retry_after = self.sids.check(sid, now)
+        if not retry_after and room_id is not None and self.room_of is not None:
+            joined = self.room_of(sid)
+            if joined is not None and str(joined) == str(room_id):
+                retry_after = self.rooms.check(joined, now)
+        if retry_after:
+            return 'rate_limited', retry_after
+        return None
+
+    # Socket.IO のハンドラに付けるデコレータ
+    # shed=False のイベントは過負荷でも断らない。per_room=False のイベントはルームごとの制限に数えない（観戦など）
+    def guard(self, event_name, shed=True, per_room=True):
+        def decorator(f):
+            @wraps(f)
+            def wrapper(data=None, *args, **kwargs):
+                room_id = data.get('room') if isinstance(data, dict) else None
+                rejected = self.admit(request.sid, room_id if per_room else None, shed)
+                if rejected:
+                    reason, retry_after = rejected
+                    key = (event_name, reason)
+                    self.rejected[key] = self.rejected.get(key, 0) + 1
+                    emit('error', {
+                        'message': 'サーバーが混雑しています。しばらくしてから再度お試しください。' if reason == 'overloaded'
+                                   else '操作が多すぎます。しばらくしてから再度お試しください。',
+                        'code': reason,
+                        'event': event_name,
+                        'retry_after': round(retry_after, 3),
+                    })
+                    log.debug('イベントを受け付けませんでした: %s', reason,
+                              extra={'event': event_name, 'room_id': room_id, 'sid': request.sid})
+                    return
+                return f(data, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    # 切断したSIDのバケットを削除する
+    def forget_sid(self, sid):
+        self.sids.discard(sid)
@@ -1,43 +1,152 @@
 # app.py
 
+import logging
+import math
 import os
 import random
-import uuid
 import time
-from flask import Flask, render_template, request, redirect, url_for, make_response, flash
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+import click
+from flask import Flask, render_template, request, redirect, url_for, make_response, flash, jsonify, session, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_socketio import SocketIO, join_room, leave_room, emit
-from flask_session import Session
+from sqlalchemy import bindparam, func, insert, or_, update
+from sqlalchemy.exc import DBAPIError
 from werkzeug.utils import secure_filename
-from threading import Lock
+from game_state import GameState
+from game_store import create_game_store
+from storage import check_schema, configure_sqlite, migrate, schema_version
+from scheduler import RoomScheduler
+from sessions import create_session_interface
+from identity import IdentityCache
+from images import ImagePipeline
+from lobby import LobbyBroadcaster, LobbyCache, OpenRoomIndex
+from query_counter import QueryCounter
+from metrics import Metrics
+from journal import GameJournal
+from outbound import COMPACT_EVENTS, COMPACT_KEYS, RoomOutbox
+from sweeper import Sweeper
+from admission import AdmissionControl
+from spectate import SpectatorFeed, current_turn_name
+from leaderboard import Leaderboard, parse_windows
+from logging_config import configure_logging, parse_sampling
 
 # Flaskアプリケーションの設定
 app = Flask(__name__)
 
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your_default_secret_key')  # 環境変数からSECRET_KEYを取得
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/your_database.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:////tmp/your_database.db')
 # app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///your_database.db'
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SESSION_TYPE'] = 'filesystem'
+# セッションの保存先（'memory' または 'redis'）。複数ワーカーの場合は 'redis' を指定する
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'memory')
+app.config['SESSION_TTL'] = int(os.environ.get('SESSION_TTL', 3600))  # 最後のアクセスからの有効期間（秒）
+app.config['SESSION_MAX_ENTRIES'] = int(os.environ.get('SESSION_MAX_ENTRIES', 10000))  # メモリに保持する最大数
 app.config['UPLOAD_FOLDER'] = 'static/images'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MBまでのアップロードを許可
-
-# 必要なディレクトリが存在しない場合は作成
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs('instance', exist_ok=True)
-
-# 拡張機能の初期化
-db = SQLAlchemy(app)
+app.config['MAX_FORM_PARTS'] = 4096  # 大きなデッキ（カード名と画像で1組2項目）を受け付ける
+# カード用に縮小した画像の最大サイズ（幅, 高さ）と、縮小を行うワーカースレッド数
+app.config['CARD_IMAGE_SIZE'] = (320, 320)
+app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 2))
+# ルームのデッキの画像を1枚のスプライトシートにまとめるか（画像がこの枚数以下のデッキのみ）
+app.config['DECK_SPRITES'] = os.environ.get('DECK_SPRITES', '1') == '1'
+app.config['SPRITE_MAX_IMAGES'] = 64
+# ゲーム画面のカードの配置を1回に返す枚数（最初のページはHTMLに埋め込み、残りは表示する直前に取得する）
+app.config['CARD_PAGE_SIZE'] = int(os.environ.get('CARD_PAGE_SIZE', 100))
+# カード画像はファイル名に内容のハッシュを含み変更されないため、長期間キャッシュさせる
+app.config['IMAGE_MAX_AGE'] = 365 * 24 * 60 * 60
+
+# ゲーム状態の保存先（'memory' または 'redis'）。複数ワーカーで動かす場合は 'redis' を指定する
+app.config['GAME_STATE_BACKEND'] = os.environ.get('GAME_STATE_BACKEND', 'memory')
+app.config['REDIS_URL'] = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# マッチ失敗時にカードを裏返すまでの秒数（デフォルト値。ルームごとにゲーム開始時に変更できる）
+app.config['FLIP_BACK_DELAY'] = float(os.environ.get('FLIP_BACK_DELAY', 1.0))
+app.config['FLIP_BACK_DELAY_RANGE'] = (0.3, 10.0)
+# 全てのカードがマッチしてからランキングを送るまでの秒数
+app.config['GAME_OVER_DELAY'] = 1.0
+# 再接続時の差分送信のために、ルームごとに残しておく直近のイベント数
+app.config['EVENT_LOG_SIZE'] = int(os.environ.get('EVENT_LOG_SIZE', 64))
+# ゲーム状態の変更を追記するジャーナル（再起動後にゲームを復元する。空文字列で無効）
+# Redis のストアでは状態がプロセスの外に残るため、デフォルトではメモリのストアの場合のみ有効
+app.config['GAME_JOURNAL_PATH'] = os.environ.get(
+    'GAME_JOURNAL_PATH', 'instance/game_journal.jsonl' if app.config['GAME_STATE_BACKEND'] == 'memory' else '')
+app.config['GAME_JOURNAL_FSYNC'] = os.environ.get('GAME_JOURNAL_FSYNC', '1') == '1'
+app.config['GAME_JOURNAL_SNAPSHOT_EVERY'] = int(os.environ.get('GAME_JOURNAL_SNAPSHOT_EVERY', 100))
+# ジャーナルがこのバイト数を超えたら、進行中のゲームの分だけに詰め直す（実行中に書き込み用のスレッドで行う）
+app.config['GAME_JOURNAL_COMPACT_BYTES'] = int(os.environ.get('GAME_JOURNAL_COMPACT_BYTES', 8 * 1024 * 1024))
+# 観戦者にゲームのイベントをまとめて送る間隔（秒）
+app.config['SPECTATOR_INTERVAL'] = float(os.environ.get('SPECTATOR_INTERVAL', 0.1))
+# ランキングの期間（'名前=秒数' をカンマ区切り。全期間の 'all' は常にある）と、1回に返す最大件数
+app.config['LEADERBOARD_WINDOWS'] = parse_windows(os.environ.get('LEADERBOARD_WINDOWS', 'day=86400,week=604800'))
+app.config['LEADERBOARD_MAX_LIMIT'] = int(os.environ.get('LEADERBOARD_MAX_LIMIT', 100))
+# ランキングをDBから作り直す間隔（秒、0で無効）。複数ワーカーで他のワーカーの結果を取り込むために使う
+app.config['LEADERBOARD_REFRESH'] = float(os.environ.get('LEADERBOARD_REFRESH', 0))
+# 放置されたルームなどの片付けの間隔（秒、0で無効）と1回に処理する件数
+app.config['SWEEP_INTERVAL'] = float(os.environ.get('SWEEP_INTERVAL', 60))
+app.config['SWEEP_BATCH'] = int(os.environ.get('SWEEP_BATCH', 100))
+# 参加者が接続しておらず、この秒数アクティビティのないルームを削除する
+app.config['ROOM_IDLE_TTL'] = float(os.environ.get('ROOM_IDLE_TTL', 24 * 60 * 60))
+# この秒数カードがめくられていないゲームを終了して待機中に戻す
+app.config['GAME_IDLE_TTL'] = float(os.environ.get('GAME_IDLE_TTL', 60 * 60))
+# Socket.IO イベントの頻度の上限（1秒あたりの回数とバースト。SIDごと、ルームごと。0で無制限）
+app.config['SOCKETIO_SID_RATE'] = float(os.environ.get('SOCKETIO_SID_RATE', 10))
+app.config['SOCKETIO_SID_BURST'] = int(os.environ.get('SOCKETIO_SID_BURST', 20))
+app.config['SOCKETIO_ROOM_RATE'] = float(os.environ.get('SOCKETIO_ROOM_RATE', 30))
+app.config['SOCKETIO_ROOM_BURST'] = int(os.environ.get('SOCKETIO_ROOM_BURST', 60))
+# 過負荷と判定する処理中のイベント数とロックの待ち時間（秒、移動平均）。超えたらめくる・参加を断る（0で無効）
+app.config['SOCKETIO_MAX_IN_FLIGHT'] = int(os.environ.get('SOCKETIO_MAX_IN_FLIGHT', 200))
+app.config['ROOM_LOCK_WAIT_LIMIT'] = float(os.environ.get('ROOM_LOCK_WAIT_LIMIT', 0.05))
+app.config['SHED_RETRY_AFTER'] = float(os.environ.get('SHED_RETRY_AFTER', 1.0))
+# このワーカーで同時に進行できるゲーム数と、1ルームの最大人数
+app.config['MAX_ACTIVE_ROOMS'] = int(os.environ.get('MAX_ACTIVE_ROOMS', 1000))
+app.config['MAX_PLAYERS_PER_ROOM'] = int(os.environ.get('MAX_PLAYERS_PER_ROOM', 8))
+# ルーム一覧の1ページあたりのルーム数と、スナップショットを作り直すまでの最大秒数
+app.config['LOBBY_PAGE_SIZE'] = int(os.environ.get('LOBBY_PAGE_SIZE', 50))
+app.config['LOBBY_CACHE_TTL'] = float(os.environ.get('LOBBY_CACHE_TTL', 5.0))
+# ロビーの変更をまとめて送信する間隔（秒）
+app.config['LOBBY_PUSH_INTERVAL'] = float(os.environ.get('LOBBY_PUSH_INTERVAL', 0.5))
+# ワーカー間でSocket.IOのemitを中継するメッセージキュー（例: redis://localhost:6379/0）
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+# Socket.IOのメッセージを msgpack で送り、ゲームのイベントを短いキーの形式にする（クライアントも msgpack 版を読み込む）
+app.config['SOCKETIO_COMPACT'] = os.environ.get('SOCKETIO_COMPACT', '0') == '1'
+# ログのレベル（本番では INFO、詳細なログは DEBUG）と形式（'text' または 'json'）
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'text')
+# イベントごとのログのサンプリング（例: 'flip_card=10' で flip_card の INFO 以下のログを10件に1件だけ出力）
+app.config['LOG_SAMPLING'] = parse_sampling(os.environ.get('LOG_SAMPLING', 'flip_card=10'))
+
+# ログ（設定と書き出し用のスレッドの開始は create_app() で行う）
+log = logging.getLogger('ss')
+
+# 拡張機能（アプリへの登録、DBのエンジンとセッションの保存先の作成は init_extensions() で行う）
+# アップロード先（static/images）とジャーナルのディレクトリは、最初に書き込むときに作成する
+if app.config['SOCKETIO_COMPACT']:
+    try:
+        import msgpack
+    except ImportError:
+        raise RuntimeError('SOCKETIO_COMPACT=1 を使うには msgpack パッケージが必要です。')
+db = SQLAlchemy()
 # socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*")  # async_mode を 'eventlet' に設定
-socketio = SocketIO(app, ping_timeout=60, ping_interval=25)
-Session(app)
+socketio = SocketIO()
+
+# テンプレートで読み込むSocket.IOクライアント（サーバーと同じ形式のもの）と短縮形の表
+@app.context_processor
+def inject_socketio_client():
+    if app.config['SOCKETIO_COMPACT']:
+        return {
+            'socketio_client_js': 'https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.5.1/socket.io.msgpack.min.js',
+            'compact_events': {short: event for event, short in COMPACT_EVENTS.items()},
+            'compact_keys': {short: key for key, short in COMPACT_KEYS.items()},
+        }
+    return {'socketio_client_js': 'https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.5.1/socket.io.min.js'}
 
 # データベースモデルの定義
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False, unique=True)
-    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=True, index=True)
     score = db.Column(db.Integer, default=0)
 
 class Room(db.Model):
@@ -67,21 +176,184 @@ class Card(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     image = db.Column(db.String(120), nullable=False)
     name = db.Column(db.String(80), nullable=False)
-    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False, index=True)
     is_matched = db.Column(db.Boolean, default=False)
     position = db.Column(db.Integer, nullable=False)  # カードの位置を管理
 
-# ゲーム状態を保持するための辞書
-game_states = {}
-game_states_lock = Lock()
+    # ルームのカードを位置の順に取得する（ゲーム画面の配置をページ単位で返す）
+    __table_args__ = (db.Index('ix_card_room_id_position', 'room_id', 'position'),)
+
+class ImageAsset(db.Model):
+    hash = db.Column(db.String(64), primary_key=True)  # 画像の内容のSHA-256
+    filename = db.Column(db.String(120), nullable=False)  # 元画像のファイル名
+    variant = db.Column(db.String(120), nullable=True)  # カード用に縮小した画像のファイル名
+    ref_count = db.Column(db.Integer, default=0)  # この画像を参照しているカードの枚数
 
-# ユーザーIDをSocket.IOのSIDに関連付けるための辞書
-user_sid_map = {}
-sid_user_map = {}
+# ゲームの結果（プレイヤーごとに1行。ゲーム終了時にまとめて1回のINSERTで追加する）
+class GameResult(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    room_id = db.Column(db.Integer, nullable=False)  # ルームは削除されても結果は残す
+    score = db.Column(db.Integer, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=False, index=True)  # UTC
+
+# ゲーム状態と、ユーザーIDとSocket.IOのSIDの対応を保持するストア
+game_store = create_game_store(app.config)
+
+# ゲーム状態の変更のジャーナル（書き込みは別スレッドでまとめて行う）
+game_journal = None
+if app.config['GAME_JOURNAL_PATH']:
+    game_journal = GameJournal(
+        app.config['GAME_JOURNAL_PATH'],
+        fsync=app.config['GAME_JOURNAL_FSYNC'],
+        snapshot_every=app.config['GAME_JOURNAL_SNAPSHOT_EVERY'],
+        compact_bytes=app.config['GAME_JOURNAL_COMPACT_BYTES']
+    )
+
+# SIDごとのプレイヤー情報（join_game で登録し、以降のイベントではDBを参照しない）
+identity_cache = IdentityCache()
+
+# Socket.IOのイベントごとのDBクエリ数
+query_counter = QueryCounter()
+query_counter.install()
+
+# 処理時間・ロック待ち時間などのメトリクス（/metrics で Prometheus のテキスト形式で出力する）
+metrics = Metrics()
+metrics.init_app(app)
+
+# Socket.IO イベントの頻度の制限と、過負荷時に新しい処理を断る受け付け制御
+admission = AdmissionControl(
+    metrics,
+    sid_rate=app.config['SOCKETIO_SID_RATE'],
+    sid_burst=app.config['SOCKETIO_SID_BURST'],
+    room_rate=app.config['SOCKETIO_ROOM_RATE'],
+    room_burst=app.config['SOCKETIO_ROOM_BURST'],
+    max_in_flight=app.config['SOCKETIO_MAX_IN_FLIGHT'],
+    max_lock_wait=app.config['ROOM_LOCK_WAIT_LIMIT'],
+    shed_retry_after=app.config['SHED_RETRY_AFTER'],
+    room_of=lambda sid: getattr(identity_cache.get(sid), 'room_id', None)
+)
+
+# ルームのロック（待ち時間と保持時間を記録する）
+def room_lock(room_id):
+    return metrics.timed_lock(game_store.lock(room_id))
+
+# ルームの遅延処理（カードを裏返す、ゲーム終了）を実行するスケジューラ
+scheduler = RoomScheduler()
+scheduler.init_app(socketio.start_background_task, socketio.sleep)
+
+# 放置されたルーム、参照されなくなった画像、古いSIDの対応などの片付け（ステップは下で登録する）
+sweeper = Sweeper(interval=app.config['SWEEP_INTERVAL'], batch=app.config['SWEEP_BATCH'])
+
+# カード用の縮小画像ができたら、元画像を参照しているカードを縮小画像に切り替える（ワーカースレッドから呼ばれる）
+def on_card_image_ready(digest, variant):
+    with app.app_context():
+        asset = db.session.get(ImageAsset, digest)
+        if asset and asset.variant != variant:
+            asset.variant = variant
+            Card.query.filter_by(image=asset.filename).update({'image': variant})
+            db.session.commit()
+            log.info('カード画像を縮小しました: %s -> %s', asset.filename, variant)
+
+# アップロード画像の保存（内容のハッシュで重複を除く）と縮小版の作成
+image_pipeline = ImagePipeline(
+    app.config['UPLOAD_FOLDER'],
+    card_size=app.config['CARD_IMAGE_SIZE'],
+    max_workers=app.config['IMAGE_WORKERS'],
+    on_variant_ready=on_card_image_ready,
+    sprite_max_images=app.config['SPRITE_MAX_IMAGES']
+)
+
+# デッキのスプライトシートの表示用の情報（まだ作成されていなければ作成を依頼して None を返す）
+def get_deck_sprite(images):
+    if not app.config['DECK_SPRITES']:
+        return None
+    manifest = image_pipeline.get_sprite(images)
+    if manifest is None:
+        return None
+    cols, rows = manifest['cols'], manifest['rows']
+    positions = {
+        filename: f"{col * 100 / (cols - 1) if cols > 1 else 0:g}% {row * 100 / (rows - 1) if rows > 1 else 0:g}%"
+        for filename, (col, row) in manifest['cells'].items()
+    }
+    return {
+        'url': url_for('card_image', filename=manifest['sheet']),
+        'size': f"{cols * 100}% {rows * 100}%",
+        'positions': positions,
+    }
+
+# ルーム一覧用に、ルームごとの参加人数を1回の集計クエリで取得する
+def load_lobby_rooms():
+    return (
+        db.session.query(Room.id, Room.name, Room.status, func.count(User.id))
+        .outerjoin(User, User.room_id == Room.id)
+        .group_by(Room.id)
+        .order_by(Room.id)
+        .all()
+    )
 
-# データベースの初期化
-with app.app_context():
-    db.create_all()
+# ルーム一覧のスナップショット（ルームの作成・参加・離脱・ゲーム開始/終了で作り直す）
+lobby_cache = LobbyCache(load_lobby_rooms, ttl=app.config['LOBBY_CACHE_TTL'])
+
+# ロビーの変更を /lobby 名前空間に差分で送る（一定間隔ごとにまとめて1回）
+lobby_broadcaster = LobbyBroadcaster(
+    lobby_cache,
+    emit=lambda event, data: socketio.emit(event, data, namespace='/lobby'),
+    schedule=lambda: scheduler.schedule(app.config['LOBBY_PUSH_INTERVAL'], 'lobby', flush_lobby_updates,
+                                         background=True)
+)
+lobby_cache.add_listener(lobby_broadcaster.mark_dirty)
+
+# クイック参加用の、参加できる待機中のルームの索引（ルームの状態と参加人数の変更のたびに差分で更新する）
+open_rooms = OpenRoomIndex(app.config['MAX_PLAYERS_PER_ROOM'])
+
+# ロビーの変更をまとめて送信する（スケジューラから呼ばれる）
+@metrics.track_task('flush_lobby_updates')
+def flush_lobby_updates():
+    with app.app_context():
+        lobby_broadcaster.flush()
+
+# ゲーム結果のランキング（全期間と直近の期間ごと。ゲーム終了時に差分で更新し、起動時にDBから作り直す）
+leaderboard = Leaderboard(app.config['LEADERBOARD_WINDOWS'])
+
+# このワーカーで開始・復元したゲームのルームID（MAX_ACTIVE_ROOMS はワーカーごとの上限）
+# ・Redis の場合 game_store.room_ids() は全ワーカーのルームを返すため、上限の判定には使わない
+local_rooms = set()
+
+# このワーカーで進行中のゲーム数
+# ・他のワーカーで終了したゲームは delete_game_state を通らないため、上限に達したときだけ
+#   ゲーム状態が残っているルームに絞り直す
+def count_local_rooms():
+    if len(local_rooms) >= app.config['MAX_ACTIVE_ROOMS']:
+        local_rooms.intersection_update(game_store.room_ids())
+    return len(local_rooms)
+
+# 出力のたびに現在の値を取得するメトリクス
+metrics.gauge('active_rooms', 'ゲーム状態を持つルーム数', lambda: len(game_store.room_ids()))
+metrics.gauge('connected_sids', 'ゲームに参加しているSocket.IOの接続数', lambda: len(identity_cache))
+metrics.gauge('scheduler_pending_timers', '未実行のタイマー数', scheduler.pending)
+metrics.gauge('scheduler_lag_max_seconds', 'タイマーの予定時刻からの最大の遅れ', lambda: scheduler.lag_max)
+metrics.counter('socketio_events_total', 'Socket.IO イベントの処理数',
+                lambda: {(name, ): s['events'] for name, s in query_counter.snapshot().items()}, ['event'])
+metrics.counter('db_queries_total', 'Socket.IO イベントで実行したDBクエリ数',
+                lambda: {(name, ): s['queries'] for name, s in query_counter.snapshot().items()}, ['event'])
+metrics.counter('outbox_events_total', 'まとめて送信したゲームのイベント数', lambda: outbox.events)
+metrics.gauge('spectators', '観戦中の接続数', lambda: spectators.viewers())
+metrics.counter('spectator_frames_total', '観戦者にイベントを送信したフレーム数', lambda: spectators.frames)
+metrics.counter('outbox_frames_total', 'ゲームのイベントを送信したフレーム数', lambda: outbox.frames)
+if game_journal:
+    metrics.counter('journal_records_total', 'ジャーナルに追記したイベント数', lambda: game_journal.appended)
+    metrics.counter('journal_commits_total', 'ジャーナルの書き込み（fsync）の回数', lambda: game_journal.commits)
+    metrics.counter('journal_compactions_total', '実行中にジャーナルを詰め直した回数', lambda: game_journal.compactions)
+metrics.gauge('leaderboard_users', 'ランキングに載っているユーザー数', lambda: len(leaderboard))
+metrics.gauge('open_rooms', 'クイック参加できる待機中のルーム数', lambda: len(open_rooms))
+metrics.gauge('socketio_events_in_flight', '処理中の Socket.IO イベント数', lambda: metrics.events_in_flight)
+metrics.gauge('room_lock_wait_avg_seconds', 'ルームのロックの待ち時間の移動平均', lambda: metrics.lock_wait_avg)
+metrics.counter('admission_rejected_total', '頻度の制限・過負荷で断った Socket.IO イベント数',
+                lambda: dict(admission.rejected), ['event', 'reason'])
+metrics.counter('sweeper_reclaimed_total', '片付けた件数',
+                lambda: {(kind, ): count for kind, count in sweeper.stats()['reclaimed'].items()}, ['kind'])
+metrics.counter('sweeper_passes_total', '片付けの実行回数', lambda: sweeper.passes)
 
 # ファイルアップロードのセキュリティチェック関数
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
@@ -92,7 +364,8 @@ def allowed_file(filename):
 # ユーザー識別と名前の設定
 @app.before_request
 def get_or_set_username():
-    if request.endpoint in ['static', 'set_username']:
+    if request.endpoint in ['static', 'card_image', 'set_username', 'metrics_endpoint', 'watch', 'watch_cards', 'game_cards',
+                            'leaderboard_endpoint']:
         return
     username = request.cookies.get('username')
     if not username and request.endpoint != 'set_username':
@@ -114,19 +387,35 @@ def set_username():
             # クッキーにユーザー名を設定
             resp = make_response(redirect(url_for('index')))
             resp.set_cookie('username', username)
-            print(f"新規ユーザー登録: {username}")
+            log.info('新規ユーザー登録: %s', username, extra={'user_id': user.id})
             return resp
         else:
             flash('名前を入力してください。')
             return redirect(url_for('set_username'))
     return render_template('set_username.html')
 
+# カード画像（ファイル名が内容のハッシュなので変更されない。長期間のキャッシュを許可する）
+@app.route('/images/<path:filename>')
+def card_image(filename):
+    resp = send_from_directory(os.path.abspath(app.config['UPLOAD_FOLDER']), filename, max_age=app.config['IMAGE_MAX_AGE'])
+    resp.headers['Cache-Control'] = f"public, max-age={app.config['IMAGE_MAX_AGE']}, immutable"
+    return resp
+
 # ルーム一覧ページ
 @app.route('/')
 def index():
-    rooms = Room.query.all()
+    rooms, page, num_pages, etag = lobby_cache.page(request.args.get('page', 1, type=int), app.config['LOBBY_PAGE_SIZE'])
+    # フラッシュメッセージがある場合は毎回描画する
+    has_flashes = '_flashes' in session
+    if not has_flashes and etag in request.if_none_match:
+        return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+
     username = request.cookies.get('username')
-    return render_template('index.html', rooms=rooms, username=username)
+    resp = make_response(render_template('index.html', rooms=rooms, page=page, num_pages=num_pages, username=username))
+    resp.headers['Cache-Control'] = 'no-cache'
+    if not has_flashes:
+        resp.set_etag(etag)
+    return resp
 
 # ルーム作成ページ
 @app.route('/create_room', methods=['GET', 'POST'])
@@ -160,22 +449,9 @@ def create_room():
             flash('ユーザーが見つかりません。再度ログインしてください。')
             return redirect(url_for('set_username'))
 
-        # ルームの作成
-        room = Room(name=room_name, creator_id=user.id)
-        db.session.add(room)
-        db.session.commit()
-        print(f"ルーム作成: {room_name} (ID: {room.id}) by {username}")
-
-        # ルーム主をルームに参加させる
-        user.room_id = room.id
-        db.session.commit()
-        print(f"{username} がルーム {room.name} に参加しました。")
-
-        # SocketIOでルームに参加している全員に通知
-        socketio.emit('user_joined', {'username': username}, room=room.id)
-
-        # カードの登録（各セットを2枚ずつ）
-        position = 1
+        # 画像のチェック（全てのファイルを確認してから保存する。途中で断った場合にファイルを残さない）
+        uploads = []       # [(ハッシュ, カード名)]
+        upload_files = {}  # ハッシュ -> (アップロードされたファイル, 拡張子)（同じ内容は最初のファイルを使う）
         for img, name in zip(card_images, card_names):
             if img and name:
                 filename = secure_filename(img.filename)
@@ -186,19 +462,85 @@ def create_room():
                 if not allowed_file(filename):
                     flash('許可されていないファイルタイプです。')
                     return redirect(url_for('create_room'))
-                # ファイル名の一意性を確保
-                unique_filename = f"{uuid.uuid4().hex}_{filename}"
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                img.save(img_path)
-                print(f"カード保存: {unique_filename} (Name: {name})")
-
-                # 各カードを2枚ずつ登録
-                for _ in range(2):
-                    card = Card(image=unique_filename, name=name, room_id=room.id, position=position)
-                    db.session.add(card)
-                    position += 1
+                ext = filename.rsplit('.', 1)[1].lower()
+                digest = image_pipeline.hash_upload(img)
+                uploads.append((digest, name))
+                upload_files.setdefault(digest, (img, ext))
+
+        # 登録済みの画像を1回のクエリで取得
+        assets = {asset.hash: asset for asset in ImageAsset.query.filter(ImageAsset.hash.in_(upload_files))}
+
+        # ルームの作成（ルーム、参加、カードの登録はまとめて1回でコミットする）
+        room = Room(name=room_name, creator_id=user.id)
+        db.session.add(room)
+        db.session.flush()  # ルームIDを確定させる
+
+        # ルーム主をルームに参加させる
+        old_room_id = user.room_id
+        user.room_id = room.id
+
+        # 登録済みの画像は参照数をSQLで加算し（同時に作成されたルームの加算を上書きしない）、登録済みのファイル名を使う
+        # 新しい画像と、片付けで画像の行（0行で分かる）やファイルが削除されていた画像だけをここで保存する
+        # （片付けは行の削除をコミットする前にファイルを削除するため、加算した後は、行が残っていればファイルも残る）
+        ref_counts = {}
+        for digest, _ in uploads:
+            ref_counts[digest] = ref_counts.get(digest, 0) + 2
+        stored_filenames = {}  # ハッシュ -> 保存先のファイル名
+        for digest, count in ref_counts.items():
+            asset = assets.get(digest)
+            if asset is not None and not db.session.execute(
+                    update(ImageAsset).where(ImageAsset.hash == digest)
+                    .values(ref_count=ImageAsset.ref_count + count)
+                    .execution_options(synchronize_session=False)).rowcount:
+                del assets[digest]  # 新しい画像として登録し直す
+                asset = None
+            img, ext = upload_files[digest]
+            stored_filename = asset.filename if asset is not None else f"{digest}.{ext}"
+            if not image_pipeline.has_file(stored_filename):
+                image_pipeline.save_upload(img, stored_filename.rsplit('.', 1)[1])
+                if asset is not None:
+                    log.info('片付けで削除された画像を保存し直しました: %s', stored_filename, extra={'user_id': user.id})
+            stored_filenames[digest] = stored_filename
+            if asset is not None and asset.variant and not image_pipeline.has_file(asset.variant):
+                asset.variant = None  # 縮小版は作り直す
+
+        # カードと新しい画像の登録（各セットを2枚ずつ、それぞれまとめて1回のINSERTで行う）
+        card_rows = []
+        new_assets = {}  # ハッシュ -> 新しく登録する画像の行
+        for digest, name in uploads:
+            asset = assets.get(digest)
+            if asset is not None:
+                card_image = asset.variant or asset.filename
+            else:
+                row = new_assets.setdefault(digest, {'hash': digest, 'filename': stored_filenames[digest], 'ref_count': 0})
+                row['ref_count'] += 2
+                card_image = row['filename']
+            log.debug('カード保存: %s (Name: %s)', card_image, name)
+
+            # 各カードを2枚ずつ登録
+            for _ in range(2):
+                card_rows.append({'image': card_image, 'name': name, 'room_id': room.id, 'position': len(card_rows) + 1})
+        # 縮小版がまだない画像（コミットで読み込み済みの値が破棄される前に集めておく）
+        pending_variants = [(asset.hash, asset.filename) for asset in assets.values() if asset.variant is None]
+        pending_variants += [(row['hash'], row['filename']) for row in new_assets.values()]
+        if new_assets:
+            db.session.execute(insert(ImageAsset), list(new_assets.values()))
+        db.session.execute(insert(Card), card_rows)
         db.session.commit()
-        print(f"ルーム {room.name} にカードが追加されました。")
+        open_rooms.move(old_room_id, None)
+        open_rooms.set_room(room.id, 'waiting', 1)
+        identity_cache.discard_user(user.id)
+        lobby_cache.invalidate()
+        sweeper.touch(room.id)
+        log.info('ルーム作成: %s by %s (カード %d 枚)', room_name, username, len(card_rows),
+                 extra={'room_id': room.id, 'user_id': user.id})
+
+        # SocketIOでルームに参加している全員に通知
+        socketio.emit('user_joined', {'username': username}, room=room.id)
+
+        # 縮小版がまだない画像はワーカーで作成し、できたらカードの画像を切り替える
+        for digest, filename in pending_variants:
+            image_pipeline.submit(digest, filename)
 
         flash('ルームが作成され、ルーム主として参加しました。')
         return redirect(url_for('index'))
@@ -211,14 +553,65 @@ def join_room_route(room_id):
     username = request.cookies.get('username')
     user = User.query.filter_by(name=username).first()
     if user and user.room_id != room_id:
+        if User.query.filter_by(room_id=room_id).count() >= app.config['MAX_PLAYERS_PER_ROOM']:
+            flash('ルームが満員です。')
+            return redirect(url_for('index'))
+        old_room_id = user.room_id
         user.room_id = room_id
         db.session.commit()
-        print(f"{username} がルーム {room.name} に参加しました。")
+        open_rooms.move(old_room_id, room_id)
+        identity_cache.discard_user(user.id)
+        lobby_cache.invalidate()
+        sweeper.touch(room_id)
+        log.info('%s がルーム %s に参加しました。', username, room.name, extra={'room_id': room_id, 'user_id': user.id})
         flash(f'{room.name} に参加しました。')
         # SocketIOでルームに参加している全員に通知
         socketio.emit('user_joined', {'username': username}, room=room_id)
     return redirect(url_for('room_detail', room_id=room_id))
 
+# クイック参加: 空き席の最も少ない（同じなら古い）待機中のルームにユーザーを参加させ、ルームを返す（なければ None）
+def quick_join_user(user):
+    for _ in range(3):
+        room_id = open_rooms.reserve(exclude=user.room_id)
+        if room_id is None:
+            return None
+        # 他のワーカーでの変更は索引に届かないため、参加する前にDBで状態と人数を確認する
+        room = db.session.get(Room, room_id)
+        if room is None:
+            open_rooms.remove(room_id)
+            continue
+        players = User.query.filter_by(room_id=room_id).count()
+        if room.status != 'waiting' or players >= app.config['MAX_PLAYERS_PER_ROOM']:
+            open_rooms.set_room(room_id, room.status, players)
+            continue
+        old_room_id = user.room_id
+        user.room_id = room_id
+        db.session.commit()
+        open_rooms.set_room(room_id, 'waiting', players + 1)
+        open_rooms.move(old_room_id, None)
+        identity_cache.discard_user(user.id)
+        lobby_cache.invalidate()
+        sweeper.touch(room_id)
+        log.info('%s がルーム %s にクイック参加しました。', user.name, room.name, extra={'room_id': room_id, 'user_id': user.id})
+        # SocketIOでルームに参加している全員に通知
+        socketio.emit('user_joined', {'username': user.name}, room=room_id)
+        return room
+    return None
+
+# クイック参加ルート
+@app.route('/quick_join', methods=['POST'])
+def quick_join():
+    user = User.query.filter_by(name=request.cookies.get('username')).first()
+    if not user:
+        flash('ユーザーが見つかりません。再度ログインしてください。')
+        return redirect(url_for('set_username'))
+    room = quick_join_user(user)
+    if room is None:
+        flash('参加できるルームがありません。ルームを作成してください。')
+        return redirect(url_for('index'))
+    flash(f'{room.name} に参加しました。')
+    return redirect(url_for('room_detail', room_id=room.id))
+
 # ルーム詳細ページ
 @app.route('/room/<int:room_id>', methods=['GET', 'POST'])
 def room_detail(room_id):
@@ -227,15 +620,25 @@ def room_detail(room_id):
     username = request.cookies.get('username')
     user = User.query.filter_by(name=username).first()
 
-    # デバッグ用のログ出力
-    print(f"Room ID: {room_id} Room Name: {room.name} User: {user.name} (ID: {user.id}) Users in Room: {[u.name for u in users]} Is Creator: {room.creator_id == user.id} Can Start: {room.creator_id == user.id and len(users) >= 2 and room.status == 'waiting'}")
+    # デバッグ用のログ出力（DEBUG のときだけ文字列を組み立てる）
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Room Name: %s User: %s Users in Room: %s Is Creator: %s', room.name, user.name,
+                  [u.name for u in users], room.creator_id == user.id, extra={'room_id': room_id, 'user_id': user.id})
 
     if request.method == 'POST':
         # 参加ボタンが押された場合（未参加ユーザーが参加）
         if user.room_id != room_id:
+            if len(users) >= app.config['MAX_PLAYERS_PER_ROOM']:
+                flash('ルームが満員です。')
+                return redirect(url_for('index'))
+            old_room_id = user.room_id
             user.room_id = room_id
             db.session.commit()
-            print(f"{username} がルーム {room.name} に参加しました。")
+            open_rooms.move(old_room_id, room_id)
+            identity_cache.discard_user(user.id)
+            lobby_cache.invalidate()
+            sweeper.touch(room_id)
+            log.info('%s がルーム %s に参加しました。', username, room.name, extra={'room_id': room_id, 'user_id': user.id})
             flash(f'{room.name} に参加しました。')
             # SocketIOでルームに参加している全員に通知
             socketio.emit('user_joined', {'username': username}, room=room_id)
@@ -250,6 +653,8 @@ def room_detail(room_id):
         users=users,
         can_start=can_start,
         is_creator=is_creator,
+        flip_back_delay=app.config['FLIP_BACK_DELAY'],
+        flip_back_delay_range=app.config['FLIP_BACK_DELAY_RANGE'],
         username=username,
         user=user  # ここで 'user' をテンプレートに渡す
     )
@@ -259,64 +664,89 @@ def room_detail(room_id):
 def start_game(room_id):
     room = Room.query.get_or_404(room_id)
     username = request.cookies.get('username')
-    print(f"Start Game: Retrieved username from cookies: {username}")
 
     user = User.query.filter_by(name=username).first()
     if not user:
         flash('ユーザーが見つかりません。再度ログインしてください。')
-        print(f"Start Game Error: User with name '{username}' not found.")
+        log.warning("Start Game Error: User with name '%s' not found.", username, extra={'room_id': room_id})
         return redirect(url_for('set_username'))
 
-    print(f"Start Game: User '{username}' found with ID {user.id} and room_id {user.room_id}")
-
     # ルームとユーザーの関連性を確認
     if user.room_id != room_id:
         flash('ルームに参加していません。')
-        print(f"Start Game Error: User '{username}' is not in room '{room_id}'.")
+        log.warning("Start Game Error: User '%s' is not in room.", username, extra={'room_id': room_id, 'user_id': user.id})
         return redirect(url_for('room_detail', room_id=room_id))
 
     if room.status != 'waiting':
         flash('既にゲームが開始されています。')
-        print(f"Start Game Error: Room '{room_id}' status is not 'waiting'.")
+        log.warning("Start Game Error: Room status is not 'waiting'.", extra={'room_id': room_id, 'user_id': user.id})
         return redirect(url_for('room_detail', room_id=room_id))
 
     if room.creator_id != user.id:
         flash('ゲームを開始する権限がありません。')
-        print(f"Start Game Error: User '{username}' is not the creator of room '{room_id}'.")
+        log.warning("Start Game Error: User '%s' is not the creator of room.", username, extra={'room_id': room_id, 'user_id': user.id})
         return redirect(url_for('room_detail', room_id=room_id))
 
     if len(room.users) < 2:
         flash('ゲームを開始するには最低2人の参加が必要です。')
-        print(f"Start Game Error: Not enough users in room '{room_id}'. Current count: {len(room.users)}")
+        log.warning('Start Game Error: Not enough users in room. Current count: %d', len(room.users), extra={'room_id': room_id, 'user_id': user.id})
         return redirect(url_for('room_detail', room_id=room_id))
 
-    # ルームの状態を「ゲーム中」に変更
+    if count_local_rooms() >= app.config['MAX_ACTIVE_ROOMS']:
+        flash('サーバーが混雑しています。しばらくしてから再度お試しください。')
+        log.warning('Start Game Error: Too many active rooms.', extra={'room_id': room_id, 'user_id': user.id})
+        return redirect(url_for('room_detail', room_id=room_id))
+
+    # ルームの状態を「ゲーム中」に変更（カードの位置と一緒にコミットする）
     room.status = 'playing'
-    db.session.commit()
-    print(f"Start Game: Room '{room_id}' status set to 'playing'")
 
-    # ゲーム状態を初期化
-    with game_states_lock:
-        cards = Card.query.filter_by(room_id=room_id).all()
-        shuffled_cards = random.sample(cards, len(cards))  # シャッフル
+    # カードを裏返すまでの秒数（ルーム作成者が指定、範囲外の値は丸める）
+    min_delay, max_delay = app.config['FLIP_BACK_DELAY_RANGE']
+    try:
+        flip_back_delay = float(request.form.get('flip_back_delay', app.config['FLIP_BACK_DELAY']))
+    except ValueError:
+        flip_back_delay = app.config['FLIP_BACK_DELAY']
+    if not math.isfinite(flip_back_delay):  # nan・inf は丸められないため既定値にする
+        flip_back_delay = app.config['FLIP_BACK_DELAY']
+    flip_back_delay = min(max(flip_back_delay, min_delay), max_delay)
+
+    # ゲーム状態を初期化（DBの読み書きはロックの外で済ませる。ORMのオブジェクトは作らない）
+    cards = db.session.query(Card.id, Card.name, Card.image).filter_by(room_id=room_id).all()
+    shuffled_cards = random.sample(cards, len(cards))  # シャッフル
+
+    # コミットで読み込み済みの値が破棄される前に、ゲーム状態を作っておく
+    game_state = GameState.from_cards(
+        shuffled_cards,
+        current_turn=room.creator_id,  # 最初のターンはルーム作成者
+        players=[u.id for u in room.users],
+        player_names={u.id: u.name for u in room.users},  # ロック中にDBを参照しないように名前も保持
+        flip_back_delay=flip_back_delay,
+        event_log_size=app.config['EVENT_LOG_SIZE']
+    )
+    deck_images = [card.image for card in cards]
 
-        # カードの位置を再設定
-        for index, card in enumerate(shuffled_cards, start=1):
-            card.position = index
-        db.session.commit()
+    # カードの位置を再設定（主キーによる一括UPDATE）
+    db.session.execute(
+        update(Card),
+        [{'id': card.id, 'position': index} for index, card in enumerate(shuffled_cards, start=1)]
+    )
+    db.session.commit()
+    open_rooms.set_status(room_id, 'playing')
+    lobby_cache.invalidate()
+    sweeper.touch(room_id)
 
-        game_states[room_id] = {
-            'cards': {card.id: {'name': card.name, 'is_flipped': False, 'is_matched': False, 'position': card.position} for card in shuffled_cards},
-            'current_turn': room.creator_id,  # 最初のターンはルーム作成者
-            'players': [u.id for u in room.users],
-            'scores': {u.id: 0 for u in room.users},
-            'flipped_cards': []
-        }
-        print(f"Start Game: Game state initialized for room '{room_id}'")
+    # ゲーム画面を開く前にデッキのスプライトシートの作成を始めておく
+    get_deck_sprite(deck_images)
+
+    with room_lock(room_id):
+        save_game_state(room_id, game_state, snapshot=True)
+        spectators.start(room_id, game_state)
+    local_rooms.add(room_id)
 
     # SocketIOでゲーム開始を通知
     socketio.emit('game_started', {'room_id': room_id}, room=room_id)
-    print(f"Start Game: 'game_started' event emitted for room '{room_id}'")
+    log.info('Start Game: %d players, %d cards', len(game_state.players), len(game_state),
+             extra={'room_id': room_id, 'user_id': user.id})
 
     # ゲームページにリダイレクト
     return redirect(url_for('game', room_id=room_id))
@@ -329,9 +759,6 @@ def game(room_id):
         flash('ゲームが開始されていません。')
         return redirect(url_for('room_detail', room_id=room_id))
 
-    # カードをシャッフルして配置（サーバー側でシャッフル済み）
-    cards = Card.query.filter_by(room_id=room_id).all()
-    sorted_cards = sorted(cards, key=lambda c: c.position)
     username = request.cookies.get('username')
     user = User.query.filter_by(name=username).first()
 
@@ -339,17 +766,238 @@ def game(room_id):
         flash('ユーザーが見つかりません。再度ログインしてください。')
         return redirect(url_for('set_username'))
 
-    # ゲーム状態から現在のターンを取得
-    with game_states_lock:
-        game_state = game_states.get(room_id)
-        if game_state:
-            current_turn_user_id = game_state.get('current_turn')
-            current_turn_user = User.query.get(current_turn_user_id)
-            current_turn_name = current_turn_user.name if current_turn_user else "不明"
+    # 参加していないユーザーは観戦ページへ（全てのカードの表の面は参加者にだけ見せる）
+    if user.room_id != room_id:
+        return redirect(url_for('watch', room_id=room_id))
+
+    # ゲーム状態から現在のターンとカードの枚数を取得
+    with room_lock(room_id):
+        game_state = game_store.get(room_id)
+        current_turn = game_state.current_turn if game_state else None
+        player_names = game_state.player_names if game_state else {}
+        num_cards = len(game_state) if game_state else None
+    if num_cards is None:
+        num_cards = Card.query.filter_by(room_id=room_id).count()
+
+    # current_turn はユーザーID（開始直後）またはユーザー名（ターン交代後）
+    if isinstance(current_turn, str):
+        current_turn_name = current_turn
+    else:
+        current_turn_name = player_names.get(current_turn, "不明")
+
+    # カードは最初のページだけを埋め込み、残りは /game/<room_id>/cards から表示する直前に取得する
+    sprite = get_room_sprite(room_id)
+    cards = load_card_layout(room_id, 0, app.config['CARD_PAGE_SIZE'], sprite)
+    return render_template('game.html', room=room, cards=cards, num_cards=num_cards,
+                           card_page_size=app.config['CARD_PAGE_SIZE'], sprite=sprite,
+                           username=username, user=user, current_turn=current_turn_name)
+
+# ゲーム画面のカードの配置（位置の順、after の位置より後を limit 枚。ルームの参加者のみ）
+@app.route('/game/<int:room_id>/cards')
+def game_cards(room_id):
+    user = User.query.filter_by(name=request.cookies.get('username')).first()
+    if not user or user.room_id != room_id:
+        return jsonify({'error': 'ルームに参加していません。'}), 403
+    after, limit = card_page_args()
+    cards = load_card_layout(room_id, after, limit, get_room_sprite(room_id))
+    return jsonify({'cards': cards, 'next': cards[-1]['position'] if len(cards) == limit else None})
+
+# 観戦ページのカードの配置（表の面は含めない。めくられたカードの表の面はイベントと一緒に届く）
+@app.route('/watch/<int:room_id>/cards')
+def watch_cards(room_id):
+    after, limit = card_page_args()
+    cards = load_card_layout(room_id, after, limit, faces=False)
+    return jsonify({'cards': cards, 'next': cards[-1]['position'] if len(cards) == limit else None})
+
+# カードの配置のページ（クエリ文字列の after と limit）
+def card_page_args():
+    after = max(request.args.get('after', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', app.config['CARD_PAGE_SIZE'], type=int), 1), app.config['CARD_PAGE_SIZE'])
+    return after, limit
+
+# 観戦ページ（ユーザー名のクッキーは不要。DBのユーザーは参照しない）
+# カードの表の面は、めくられているカードの分だけ観戦用のスナップショットで届く
+@app.route('/watch/<int:room_id>')
+def watch(room_id):
+    room = Room.query.get_or_404(room_id)
+    game_state = game_store.get(room_id)
+    if room.status != 'playing' or game_state is None:
+        flash('ゲームが開始されていません。')
+        return redirect(url_for('index'))
+    cards = load_card_layout(room_id, 0, app.config['CARD_PAGE_SIZE'], faces=False)
+    return render_template('game.html', room=room, cards=cards, num_cards=len(game_state),
+                           card_page_size=app.config['CARD_PAGE_SIZE'], sprite=None, spectator=True,
+                           username=request.cookies.get('username', ''), user=None,
+                           current_turn=current_turn_name(game_state))
+
+# ルームのデッキのスプライト（画像の種類がスプライトの上限を超える場合は、上限+1件だけ読んで None）
+def get_room_sprite(room_id):
+    images = [image for image, in db.session.query(Card.image).filter_by(room_id=room_id).distinct()
+              .limit(app.config['SPRITE_MAX_IMAGES'] + 1)]
+    if len(images) > app.config['SPRITE_MAX_IMAGES']:
+        return None
+    return get_deck_sprite(images)
+
+# カードの配置を (room_id, position) のインデックスで位置の順に読む（faces=False の場合、表の面は含めない）
+def load_card_layout(room_id, after, limit, sprite=None, faces=True):
+    if not faces:
+        rows = (
+            db.session.query(Card.id, Card.position)
+            .filter(Card.room_id == room_id, Card.position > after)
+            .order_by(Card.position)
+            .limit(limit)
+        )
+        return [{'id': card_id, 'position': position} for card_id, position in rows]
+    rows = (
+        db.session.query(Card.id, Card.position, Card.name, Card.image)
+        .filter(Card.room_id == room_id, Card.position > after)
+        .order_by(Card.position)
+        .limit(limit)
+    )
+    return [{
+        'id': card_id,
+        'position': position,
+        'name': name,
+        'image': url_for('card_image', filename=image),
+        'sprite': sprite['positions'].get(image) if sprite else None,
+    } for card_id, position, name, image in rows]
+
+# Socket.IOのイベントごとのDBクエリ数
+@app.route('/db_stats')
+def db_stats():
+    return jsonify(query_counter.snapshot())
+
+# スケジューラの状態（未実行のタイマー数、タイマーの遅れ）
+@app.route('/scheduler_stats')
+def scheduler_stats():
+    return jsonify(scheduler.stats())
+
+# 片付けの状態（実行回数、種類ごとの片付けた件数、直近の実行時間）
+@app.route('/sweeper_stats')
+def sweeper_stats():
+    return jsonify(sweeper.stats())
+
+# Prometheus のテキスト形式のメトリクス（ユーザー名のクッキーは不要）
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# ランキング（上位N件と、指定したユーザーの順位。メモリのランキングから返し、結果のテーブルは読まない）
+# GET /leaderboard?window=all|day|week&limit=10&user=<ユーザー名>
+@app.route('/leaderboard')
+def leaderboard_endpoint():
+    window = request.args.get('window', 'all')
+    if window != 'all' and window not in leaderboard.windows:
+        return jsonify({'error': f"不明な期間です: {window}", 'windows': ['all', *leaderboard.windows]}), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 1), app.config['LEADERBOARD_MAX_LIMIT'])
+    name = request.args.get('user') or request.cookies.get('username')
+    top = leaderboard.top(window, limit)
+    etag = f"{window}-{limit}-{leaderboard.version}-{name or ''}"
+    if etag in request.if_none_match:
+        return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    user_id = leaderboard.user_id(name) if name else None
+    resp = jsonify({
+        'window': window,
+        'top': top,
+        'user': leaderboard.rank(user_id, window) if user_id is not None else None,
+    })
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.set_etag(etag)
+    return resp
+
+# ゲームの結果を保存する（結果の追加とユーザーの合計スコアの加算を1回のコミットで行う）
+# ルームの状態を待機中に戻す変更も同じコミットに含める。ランキングはコミットの後に更新する
+def save_game_results(room_id, game_state):
+    finished_at = datetime.now(timezone.utc)
+    results = [{'user_id': user_id, 'room_id': room_id, 'score': score, 'finished_at': finished_at.replace(tzinfo=None)}
+               for user_id, score in game_state.scores.items()]
+    if results:
+        db.session.execute(insert(GameResult), results)
+        db.session.execute(
+            update(User.__table__).where(User.id == bindparam('uid'))
+            .values(score=func.coalesce(User.score, 0) + bindparam('points')),
+            [{'uid': r['user_id'], 'points': r['score']} for r in results]
+        )
+    Room.query.filter_by(id=room_id).update({'status': 'waiting'})
+    db.session.commit()
+    leaderboard.record([(finished_at.timestamp(), r['user_id'], game_state.player_names.get(r['user_id']), r['score'])
+                        for r in results])
+
+# ランキングをDBから作り直す（全期間はユーザーの合計スコア、期間ごとは最も長い期間内の結果だけを読む）
+def rebuild_leaderboard():
+    started_at = time.perf_counter()
+    totals = db.session.query(User.id, User.name, User.score).filter(User.score > 0).all()
+    results = []
+    if leaderboard.windows:
+        since = datetime.now(timezone.utc) - timedelta(seconds=max(leaderboard.windows.values()))
+        results = [
+            (finished_at.replace(tzinfo=timezone.utc).timestamp(), user_id, name, score)
+            for finished_at, user_id, name, score in
+            db.session.query(GameResult.finished_at, GameResult.user_id, User.name, GameResult.score)
+            .join(User, User.id == GameResult.user_id)
+            .filter(GameResult.finished_at >= since.replace(tzinfo=None))
+            .order_by(GameResult.finished_at)
+        ]
+    leaderboard.rebuild(totals, results)
+    log.debug('ランキングを作り直しました（ユーザー: %d、期間内の結果: %d、%.3f 秒）',
+              len(totals), len(results), time.perf_counter() - started_at)
+
+# ルームの参加者名の一覧（1クエリで取得）
+def get_player_names(room_id):
+    return [name for name, in User.query.with_entities(User.name).filter_by(room_id=room_id)]
+
+# ルームの全員にゲームのイベントを送信する
+# （連番を付けて記録し、再接続したクライアントには見逃した分だけを送れるようにする）
+# （送信は outbox に溜め、処理の最後に flush_game_events() でまとめて送る）
+def emit_game_event(game_state, room_id, event, data):
+    data = game_state.record_event(event, data)
+    if game_journal:
+        game_journal.append(room_id, game_state.seq, event, data)
+    outbox.add(room_id, event, data)
+    spectators.publish(room_id, event, data)
+
+def flush_game_events(room_id):
+    outbox.flush(room_id)
+
+# 変更したゲーム状態を書き戻す（ジャーナルには一定数のイベントごと、またはゲーム開始時にスナップショットを書く）
+def save_game_state(room_id, game_state, snapshot=False):
+    game_state.updated_at = time.time()
+    game_store.save(room_id, game_state)
+    if game_journal:
+        if snapshot:
+            game_journal.snapshot(room_id, game_state)
         else:
-            current_turn_name = "不明"
-
-    return render_template('game.html', room=room, cards=sorted_cards, username=username, user=user, current_turn=current_turn_name)
+            game_journal.maybe_snapshot(room_id, game_state)
+
+def delete_game_state(room_id):
+    spectators.end(room_id)  # 未送信のイベントをゲーム状態から送ってから削除する
+    game_store.delete(room_id)
+    local_rooms.discard(room_id)
+    if game_journal:
+        game_journal.end(room_id)
+
+# 観戦者のグループ（プレイヤーとは別の Socket.IO のルーム）
+def watch_room(room_id):
+    return f"watch:{room_id}"
+
+# 観戦用の配信（共有のゲーム状態の連番とイベントの記録から、プレイヤーとは別に一定間隔ごとにまとめて送る）
+spectators = SpectatorFeed(
+    load=game_store.get,
+    emit=lambda event, data, room_id: socketio.emit(event, data, room=watch_room(room_id)),
+    schedule=lambda delay, room_id: scheduler.schedule(delay, watch_room(room_id), flush_spectators, room_id,
+                                                        background=True),
+    interval=app.config['SPECTATOR_INTERVAL'],
+    shared=bool(app.config['SOCKETIO_MESSAGE_QUEUE'])
+)
+
+# 観戦者にイベントを送る（スケジューラから呼ばれる）
+@metrics.track_task('flush_spectators')
+def flush_spectators(room_id):
+    spectators.flush(room_id)
+
+# ゲームのイベントの送信バッファ（ルームのロック内で発生したイベントを1つのフレームにまとめる）
+outbox = RoomOutbox(lambda event, data, room_id: socketio.emit(event, data, room=room_id),
+                    compact=app.config['SOCKETIO_COMPACT'])
 
 # ルームが空になった場合に状態をリセットする関数
 def reset_room_if_empty(room_id):
@@ -357,73 +1005,127 @@ def reset_room_if_empty(room_id):
     if room_obj and len(room_obj.users) == 0:
         room_obj.status = 'waiting'
         db.session.commit()
-        with game_states_lock:
-            if room_id in game_states:
-                del game_states[room_id]
-        print(f"Room {room_id} is now empty. Resetting to 'waiting' state.")
+        open_rooms.set_status(room_id, 'waiting')
+        lobby_cache.invalidate()
+        scheduler.cancel(room_id)  # 未実行の遅延処理を取り消す
+        with room_lock(room_id):
+            delete_game_state(room_id)
+        log.info("Room is now empty. Resetting to 'waiting' state.", extra={'room_id': room_id})
 
 # SocketIO イベントハンドリング
+
+# ロビー: 接続時にルーム一覧のスナップショットを送り、以降は lobby_diff で差分を送る
+@socketio.on('connect', namespace='/lobby')
+@metrics.track_event('lobby_connect')
+def handle_lobby_connect():
+    emit('lobby_snapshot', lobby_broadcaster.snapshot())
+
+# ロビー: クイック参加（参加したルームのURLを返し、クライアントが移動する）
+@socketio.on('quick_join', namespace='/lobby')
+@metrics.track_event('quick_join')
+@admission.guard('quick_join')
+def handle_quick_join(data):
+    user = User.query.filter_by(name=data.get('username')).first()
+    if not user:
+        emit('error', {'message': 'ユーザーが見つかりません。'})
+        return
+    room = quick_join_user(user)
+    if room is None:
+        emit('quick_join_result', {'room_id': None, 'message': '参加できるルームがありません。ルームを作成してください。'})
+        return
+    emit('quick_join_result', {'room_id': room.id, 'url': url_for('room_detail', room_id=room.id)})
+
+# 観戦: 観戦者のグループに入り、共有のゲーム状態から作った観戦用のスナップショットを送る
+# （DBは参照せず、ルームのロックも取らない。グループに入ってからゲーム状態を読み、その後のイベントを取りこぼさない）
+@socketio.on('watch_game')
+@metrics.track_event('watch_game')
+@admission.guard('watch_game', per_room=False)
+def handle_watch_game(data):
+    room_id = data.get('room')
+    join_room(watch_room(room_id))
+    snapshot = spectators.watch(request.sid, room_id)
+    if snapshot is None:
+        leave_room(watch_room(room_id))
+        emit('error', {'message': 'ゲームが開始されていません。'})
+        return
+    emit('game_state', snapshot)
+    log.debug('Spectator joined (%d viewers)', spectators.viewers(room_id),
+              extra={'event': 'watch_game', 'room_id': room_id, 'sid': request.sid})
+
 @socketio.on('join_game')
+@metrics.track_event('join_game')
+@admission.guard('join_game')
+@query_counter.track('join_game')
 def handle_join_game(data):
     room_id = data.get('room')
     username = data.get('username')
+    last_seq = data.get('last_seq')  # 再接続時、クライアントが最後に受け取ったイベントの連番
     user = User.query.filter_by(name=username).first()
 
     if not user:
         emit('error', {'message': 'ユーザーが見つかりません。'})
-        print(f"Error: User '{username}' not found.")
+        log.warning("Error: User '%s' not found.", username, extra={'event': 'join_game', 'room_id': room_id})
         return
 
     if user.room_id != room_id:
         emit('error', {'message': 'ルームに参加していません。'})
-        print(f"Error: User '{username}' is not in room '{room_id}'.")
+        log.warning("Error: User '%s' is not in room.", username, extra={'event': 'join_game', 'room_id': room_id, 'user_id': user.id})
         return
 
     join_room(room_id)
-    user_sid_map[user.id] = request.sid
-    sid_user_map[request.sid] = user.id
-    print(f"{username} joined SocketIO room {room_id} with SID {request.sid}")
-
-    with game_states_lock:
-        if room_id in game_states:
-            game_state = game_states[room_id]
-            emit('game_state', game_state, room=request.sid)
-            print(f"Game state sent to user '{username}' in room '{room_id}'")
+    game_store.bind_sid(user.id, request.sid)
+    sweeper.touch(room_id)
+    identity_cache.bind(request.sid, user.id, user.name, room_id)
+    fields = {'event': 'join_game', 'room_id': room_id, 'user_id': user.id, 'sid': request.sid}
+    log.info('%s joined SocketIO room', username, extra=fields)
+
+    with room_lock(room_id):
+        game_state = game_store.get(room_id)
+        if game_state:
+            # 見逃したイベントだけを送る。バッファから溢れている場合はカード名を伏せたスナップショットを送る
+            missed = game_state.events_since(last_seq) if isinstance(last_seq, int) else None
+            if missed is not None:
+                emit('game_events', {'events': missed, 'seq': game_state.seq}, room=request.sid)
+                log.debug('%d missed events sent', len(missed), extra=fields)
+            else:
+                emit('game_state', game_state.to_payload(redact=True), room=request.sid)
+                log.debug('Game state sent', extra=fields)
 
-    # 現在の参加者リストを送信
-    current_players = [u.name for u in Room.query.get(room_id).users]
-    emit('update_player_list', {'players': current_players}, room=room_id)
-    print(f"Updated player list sent to room '{room_id}': {current_players}")
+    # 参加者リストの全体は参加したクライアントにだけ送り、他の参加者には差分（user_joined）を送る
+    current_players = get_player_names(room_id)
+    emit('update_player_list', {'players': current_players}, room=request.sid)
+    emit('user_joined', {'username': user.name}, room=room_id, skip_sid=request.sid)
+    log.debug('Player list sent: %s', current_players, extra=fields)
 
 @socketio.on('leave_game')
+@metrics.track_event('leave_game')
+@admission.guard('leave_game', shed=False)
+@query_counter.track('leave_game')
 def handle_leave_game(data):
     room_id = data.get('room')
     username = data.get('username')
-    user = User.query.filter_by(name=username).first()
+    identity = identity_cache.get(request.sid)
 
-    if not user or user.room_id != room_id:
+    if not identity or identity.room_id != room_id:
         emit('error', {'message': 'ルームから離脱できません。'})
-        print(f"Error: User '{username}' cannot leave room '{room_id}'.")
+        log.warning("Error: User '%s' cannot leave room.", username, extra={'event': 'leave_game', 'room_id': room_id, 'sid': request.sid})
         return
 
     leave_room(room_id)
-    user.room_id = None
+    User.query.filter_by(id=identity.user_id).update({'room_id': None})
     db.session.commit()
-    print(f"{username} がルーム {room_id} から離脱しました。")
+    open_rooms.move(room_id, None)
+    lobby_cache.invalidate()
+    fields = {'event': 'leave_game', 'room_id': room_id, 'user_id': identity.user_id, 'sid': request.sid}
+    log.info('%s がルームから離脱しました。', identity.name, extra=fields)
 
-    # 他のプレイヤーにユーザーが離脱したことを通知
-    emit('user_left', {'username': username}, room=room_id)
+    # 他のプレイヤーにユーザーが離脱したことを通知（参加者リストからの削除もこの差分で行う）
+    emit('user_left', {'username': identity.name}, room=room_id)
 
-    # 参加者リストを更新
-    current_players = [u.name for u in Room.query.get(room_id).users if u.id != user.id]
-    emit('update_player_list', {'players': current_players}, room=room_id)
-    print(f"参加者リストが更新されました。Room ID: {room_id}: {current_players}")
-
-    # マップから削除
-    if user.id in user_sid_map:
-        sid = user_sid_map[user.id]
-        del sid_user_map[sid]
-        del user_sid_map[user.id]
+    # マップとキャッシュから削除
+    game_store.unbind_user(identity.user_id)
+    identity_cache.discard_user(identity.user_id)
+    sweeper.touch(room_id)
 
     emit('left_room', {'message': 'ルームから離脱しました。'}, room=request.sid)
 
@@ -431,190 +1133,427 @@ def handle_leave_game(data):
     reset_room_if_empty(room_id)
 
 @socketio.on('disconnect')
+@metrics.track_event('disconnect')
+@query_counter.track('disconnect')
 def handle_disconnect():
     sid = request.sid
-    user_id = sid_user_map.get(sid)
-    if user_id:
-        user = User.query.get(user_id)
-        if user:
-            room_id = user.room_id
-            print(f"{user.name} (ID: {user.id}) がルーム {room_id} から切断しました。 SID: {sid}")
-
-            # SocketIOのルームからユーザーを離脱
-            leave_room(room_id)
+    identity = identity_cache.pop(sid)
+    admission.forget_sid(sid)
+    spectators.unwatch(sid)
+    if identity:
+        room_id = identity.room_id
+        fields = {'event': 'disconnect', 'room_id': room_id, 'user_id': identity.user_id, 'sid': sid}
+        log.info('%s がルームから切断しました。', identity.name, extra=fields)
 
-            # 他のプレイヤーにユーザーが離脱したことを通知
-            emit('user_left', {'username': user.name}, room=room_id)
+        # SocketIOのルームからユーザーを離脱
+        leave_room(room_id)
 
-            # 参加者リストを更新
-            current_players = [u.name for u in Room.query.get(room_id).users if u.id != user.id]
-            emit('update_player_list', {'players': current_players}, room=room_id)
-            print(f"参加者リストが更新されました。Room ID: {room_id}: {current_players}")
+        # 他のプレイヤーにユーザーが離脱したことを通知（参加者リストからの削除もこの差分で行う）
+        emit('user_left', {'username': identity.name}, room=room_id)
 
-        # マップから削除
-        del user_sid_map[user_id]
-        del sid_user_map[sid]
+        # マップから削除（同じユーザーが別のSIDで再接続している場合はそのままにする）
+        if game_store.get_sid(identity.user_id) == sid:
+            game_store.unbind_user(identity.user_id)
 
         # ルームが空になった場合にリセット
         reset_room_if_empty(room_id)
     else:
-        print(f"未登録のSID: {sid} が切断しました。")
+        log.debug('未登録のSIDが切断しました。', extra={'event': 'disconnect', 'sid': sid})
+
+# マッチ失敗: 一定時間後にカードを裏返してターンを交代する（スケジューラから呼ばれる）
+@metrics.track_task('reset_cards')
+def reset_cards(room_id, card1_id, card2_id, user_id):
+    with app.app_context():
+        with room_lock(room_id):
+            # 待機中に他のワーカーが状態を変更している可能性があるため、ストアから読み直す
+            game_state = game_store.get(room_id)
+            if not game_state:
+                log.warning('Game state not found.', extra={'event': 'cards_reset', 'room_id': room_id})
+                return
+
+            # カードを裏返す
+            if game_state.has_card(card1_id) and game_state.has_card(card2_id):
+                game_state.unflip(card1_id)
+                game_state.unflip(card2_id)
+
+                # カードリセットを通知
+                emit_game_event(game_state, room_id, 'cards_reset', {'card1_id': card1_id, 'card2_id': card2_id})
+                log.debug('カード %s と %s が裏返されました。', card1_id, card2_id, extra={'event': 'cards_reset', 'room_id': room_id})
+
+            # ターンを次のプレイヤーに変更
+            players = game_state.players
+            current_index = players.index(user_id)
+            next_player_id = players[(current_index + 1) % len(players)]
+            next_player_name = game_state.player_names.get(next_player_id)
+            if next_player_name:
+                game_state.current_turn = next_player_name
+                emit_game_event(game_state, room_id, 'turn_changed', {'current_turn': next_player_name})
+                log.debug('ターンが %s に変更されました。', next_player_name, extra={'event': 'turn_changed', 'room_id': room_id})
+
+            # フリップされたカードをリセット
+            game_state.flipped_cards = []
+            save_game_state(room_id, game_state)
+            flush_game_events(room_id)
+
+# 全てのカードがマッチした後、遅延してランキングを作成して表示（スケジューラから呼ばれる）
+@metrics.track_task('delayed_game_over')
+def delayed_game_over(room_id):
+    with app.app_context():
+        # 現在のゲーム状態を取得
+        game_state = game_store.get(room_id)
+
+        # ランキングを作成して全プレイヤーに送信
+        if game_state:
+            ranking = sorted(game_state.scores.items(), key=lambda x: x[1], reverse=True)
+            ranking_data = [{'username': game_state.player_names.get(user_id, "不明"), 'score': score}
+                            for user_id, score in ranking]
+            socketio.emit('game_over', {'ranking': ranking_data}, room=room_id)
+            socketio.emit('game_over', {'ranking': ranking_data}, room=watch_room(room_id))
+            log.info('ゲーム終了: ランキングが送信されました。', extra={'event': 'game_over', 'room_id': room_id})
+
+            # 結果を保存し、ルームの状態を待機中に戻す
+            save_game_results(room_id, game_state)
+            open_rooms.set_status(room_id, 'waiting')
+            lobby_cache.invalidate()
+
+            # ゲーム状態を削除して完全にリセット
+            with room_lock(room_id):
+                delete_game_state(room_id)  # ルームごとの状態をリセット
+            log.debug('ゲーム状態が完全にリセットされました。', extra={'event': 'game_over', 'room_id': room_id})
 
 # カードをめくるイベント
 @socketio.on('flip_card')
+@metrics.track_event('flip_card')
+@admission.guard('flip_card')
+@query_counter.track('flip_card')
 def handle_flip_card(data):
     room_id = data.get('room')
     card_id = data.get('card_id')
     username = data.get('username')
-    user = User.query.filter_by(name=username).first()
+    user = identity_cache.get(request.sid)  # join_game で登録済みのプレイヤー情報（DBは参照しない）
 
     if not user or user.room_id != room_id:
         emit('error', {'message': 'カードをめくる権限がありません。'})
-        print(f"エラー: ユーザー {username} がルーム {room_id} に所属していません。")
+        log.warning('エラー: ユーザー %s がルームに所属していません。', username, extra={'event': 'flip_card', 'room_id': room_id, 'sid': request.sid})
         return
 
-    print(f"{username} がルーム {room_id} のカード {card_id} をめくりました。")
+    # ロック内のログはキューに入れるだけ（DEBUG のログは無効なら引数の文字列化も行わない）
+    fields = {'event': 'flip_card', 'room_id': room_id, 'user_id': user.user_id}
 
-    with game_states_lock:
-        if room_id not in game_states:
+    with room_lock(room_id):
+        game_state = game_store.get(room_id)
+        if not game_state:
             emit('error', {'message': 'ゲーム状態が見つかりません。'})
-            print(f"エラー: Room {room_id} のゲーム状態が見つかりません。")
+            log.warning('エラー: ゲーム状態が見つかりません。', extra=fields)
             return
 
-        game_state = game_states[room_id]
-
         # 現在のターンのプレイヤーか確認
-        if game_state['current_turn'] != user.name and game_state['current_turn'] != user.id:
+        if game_state.current_turn != user.name and game_state.current_turn != user.user_id:
             emit('error', {'message': '現在のターンではありません。'})
-            print(f"エラー: {username} は現在のターンではありません。")
-            print(game_state['current_turn'])
-            print(user.name)
-            # print(game_state)
+            log.debug('エラー: %s は現在のターンではありません。(current_turn: %s)', user.name, game_state.current_turn, extra=fields)
             return
 
         try:
             card_id_int = int(card_id)
         except ValueError:
             emit('error', {'message': '無効なカードIDです。'})
-            print(f"エラー: 無効なカードID '{card_id}' が送信されました。")
+            log.warning("エラー: 無効なカードID '%s' が送信されました。", card_id, extra=fields)
             return
 
-        card = game_state['cards'].get(card_id_int)
-        if not card:
+        if not game_state.has_card(card_id_int):
             emit('error', {'message': 'カードが見つかりません。'})
-            print(f"エラー: Room {room_id} にカード {card_id} が存在しません。")
+            log.warning('エラー: カード %s が存在しません。', card_id, extra=fields)
             return
-        if card['is_flipped'] or card['is_matched']:
+        if game_state.is_flipped(card_id_int) or game_state.is_matched(card_id_int):
             emit('error', {'message': '既にめくられたカードです。'})
-            print(f"エラー: Room {room_id} のカード {card_id} は既にめくられています。")
+            log.debug('エラー: カード %s は既にめくられています。', card_id, extra=fields)
             return
 
         # カードをめくる
-        card['is_flipped'] = True
-        game_state['flipped_cards'].append(card_id_int)
-        print(f"カード {card_id} がめくられました。")
-
-        # デバッグ用にカード情報をログ出力
-        print(f"カード情報: {game_state['cards'][card_id_int]}")
+        game_state.flip(card_id_int)
+        sweeper.touch(room_id)
+        log.debug('カード %s がめくられました。(Position: %d)', card_id, game_state.position(card_id_int), extra=fields)
 
         # 全プレイヤーにカードがめくられたことを通知
-        emit('card_flipped', {'card_id': card_id, 'position': card['position'], 'username': username}, room=room_id)
-        print(f"カード {card_id} のめくりが Room {room_id} の全プレイヤーに通知されました。")
+        emit_game_event(game_state, room_id, 'card_flipped', {'card_id': card_id_int, 'position': game_state.position(card_id_int), 'username': user.name})
 
-        if len(game_state['flipped_cards']) == 2:
-            card1_id, card2_id = game_state['flipped_cards']
-            card1 = game_state['cards'][card1_id]
-            card2 = game_state['cards'][card2_id]
+        if len(game_state.flipped_cards) == 2:
+            card1_id, card2_id = game_state.flipped_cards
 
-            if card1['name'] == card2['name']:
+            if game_state.is_pair(card1_id, card2_id):
                 # マッチ成功
-                card1['is_matched'] = True
-                card2['is_matched'] = True
-                game_state['scores'][user.id] += 1
-                emit('match_result', {
+                game_state.mark_matched(card1_id, card2_id)
+                game_state.scores[user.user_id] += 1
+                emit_game_event(game_state, room_id, 'match_result', {
                     'card1_id': card1_id,
                     'card2_id': card2_id,
                     'matched': True,
-                    'scores': game_state['scores']
-                }, room=room_id)
-                print(f"マッチ成功: カード {card1_id} と {card2_id} が一致しました。 Room ID: {room_id}")
+                    'scores': game_state.scores_payload()
+                })
+                log.debug('マッチ成功: カード %s と %s が一致しました。', card1_id, card2_id, extra=fields)
 
-                game_state['flipped_cards'] = []
+                game_state.flipped_cards = []
 
-                # 全てのカードがマッチしたか確認
-                all_matched = all(c['is_matched'] for c in game_state['cards'].values())
-                if all_matched:
+                # 全てのカードがマッチしたか確認（マッチしたペア数で判定）
+                if game_state.is_complete():
                     # 遅延後にランキングを作成して表示
-                    def delayed_game_over(room_id):
-                        with app.app_context():
-                            time.sleep(1)  # 1秒待機
-
-                            # 現在のゲーム状態を取得
-                            game_state = game_states.get(room_id)
-                            
-                            # ランキングを作成して全プレイヤーに送信
-                            if game_state:
-                                ranking = sorted(game_state['scores'].items(), key=lambda x: x[1], reverse=True)
-                                ranking_data = []
-                                for user_id, score in ranking:
-                                    user_obj = User.query.get(user_id)
-                                    ranking_data.append({'username': user_obj.name, 'score': score})
-                                socketio.emit('game_over', {'ranking': ranking_data}, room=room_id)
-                                print(f"ゲーム終了: Room ID: {room_id} のランキングが送信されました。")
-
-                                # ルームの状態を待機中に戻す
-                                room_obj = Room.query.get(room_id)
-                                room_obj.status = 'waiting'
-                                db.session.commit()
-
-                                # ゲーム状態を削除して完全にリセット
-                                with game_states_lock:
-                                    if room_id in game_states:
-                                        del game_states[room_id]  # ルームごとの状態をリセット
-                                print(f"Room {room_id} のゲーム状態が完全にリセットされました。")
-
-                    # 背景タスクでdelayed_game_overを実行
-                    socketio.start_background_task(delayed_game_over, room_id)
+                    scheduler.schedule(app.config['GAME_OVER_DELAY'], room_id, delayed_game_over, room_id,
+                                       background=True)
             else:
-                # マッチ失敗: 一定時間後にカードを裏返す
-                def reset_cards(room_id, card1_id, card2_id, user_id, card1, card2):
-                    with app.app_context():
-                        game_state = game_states.get(room_id)
-                        if not game_state:
-                            print(f"Game state for room {room_id} not found.")
-                            return
-
-                        time.sleep(1)  # 1秒待機
-
-                        # カードを裏返す
-                        # card1 = Card.query.get(card1_id)
-                        # card2 = Card.query.get(card2_id)
-                        if card1 and card2:
-                            card1['is_flipped'] = False
-                            card2['is_flipped'] = False
-                            db.session.commit()
-
-                            # カードリセットを通知
-                            socketio.emit('cards_reset', {'card1_id': card1_id, 'card2_id': card2_id}, room=room_id)
-                            print(f"カード {card1_id} と {card2_id} が Room {room_id} で裏返されました。")
-
-                        # ターンを次のプレイヤーに変更
-                        players = game_state['players']
-                        current_index = players.index(user_id)
-                        next_player_id = players[(current_index + 1) % len(players)]
-                        next_player_obj = User.query.get(next_player_id)
-                        if next_player_obj:
-                            game_state['current_turn'] = next_player_obj.name
-                            db.session.commit()
-                            socketio.emit('turn_changed', {'current_turn': next_player_obj.name}, room=room_id)
-                            print(f"ターンが {next_player_obj.name} に変更されました。 Room ID: {room_id}")
-
-                        # フリップされたカードをリセット
-                        game_state['flipped_cards'] = []
-
-                # 背景タスクでreset_cardsを実行
-                socketio.start_background_task(reset_cards, room_id, card1_id, card2_id, user.id, card1, card2)
-                print(f"マッチ失敗: カード {card1_id} と {card2_id} が一致しませんでした。 Room ID: {room_id}")
+                # マッチ失敗: ルームごとの秒数が経過した後にカードを裏返す
+                scheduler.schedule(game_state.flip_back_delay, room_id, reset_cards, room_id, card1_id, card2_id, user.user_id)
+                log.debug('マッチ失敗: カード %s と %s が一致しませんでした。', card1_id, card2_id, extra=fields)
+
+        # 変更したゲーム状態を書き戻し、この処理で発生したイベントをまとめて送る
+        save_game_state(room_id, game_state)
+        flush_game_events(room_id)
+
+# 片付け: ルームを削除する（参加者はルームから外し、カードが参照していた画像の参照数を減らす）
+# 参照数が0になった画像は sweep_images()、その画像を使っていたスプライトは sweep_sprites() で削除する
+def delete_rooms(room_ids):
+    image_counts = dict(db.session.query(Card.image, func.count(Card.id))
+                        .filter(Card.room_id.in_(room_ids)).group_by(Card.image))
+    for image, count in image_counts.items():
+        ImageAsset.query.filter(or_(ImageAsset.filename == image, ImageAsset.variant == image)).update(
+            {'ref_count': ImageAsset.ref_count - count}, synchronize_session=False)
+    user_ids = [user_id for user_id, in db.session.query(User.id).filter(User.room_id.in_(room_ids))]
+    User.query.filter(User.room_id.in_(room_ids)).update({'room_id': None}, synchronize_session=False)
+    cards = Card.query.filter(Card.room_id.in_(room_ids)).delete(synchronize_session=False)
+    Room.query.filter(Room.id.in_(room_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+    for room_id in room_ids:
+        scheduler.cancel(room_id)
+        with room_lock(room_id):
+            delete_game_state(room_id)
+        sweeper.forget(room_id)
+        open_rooms.remove(room_id)
+    for user_id in user_ids:
+        identity_cache.discard_user(user_id)
+    lobby_cache.invalidate()
+    return cards
+
+# 片付け用に、ルームIDを after より後から ID の順に limit 件読む（主キーの範囲を読むだけで、テーブル全体は読まない）
+def load_room_ids(after, limit, **filters):
+    query = db.session.query(Room.id).filter_by(**filters)
+    if after is not None:
+        query = query.filter(Room.id > after)
+    return [room_id for room_id, in query.order_by(Room.id).limit(limit)]
+
+# 片付け: 参加者が誰も接続しておらず、ROOM_IDLE_TTL 秒以上アクティビティのないルームを削除する
+def sweep_idle_rooms(batch):
+    room_ids = sweeper.next_page('rooms', load_room_ids, batch)
+    idle = [room_id for room_id in room_ids if sweeper.idle_for(room_id) >= app.config['ROOM_IDLE_TTL']]
+    if not idle:
+        return {}
+    connected = {room_id for user_id, room_id in db.session.query(User.id, User.room_id).filter(User.room_id.in_(idle))
+                 if game_store.get_sid(user_id) is not None}
+    expired = [room_id for room_id in idle if room_id not in connected]
+    if not expired:
+        return {}
+    return {'rooms': len(expired), 'cards': delete_rooms(expired)}
+
+# ゲームの最後の保存からの秒数
+# ・ゲーム状態に記録した時刻で判定する（Redis の場合、他のワーカーで進んだゲームもこのワーカーから正しく判定できる）
+# ・時刻のない（記録を始める前に保存された）ゲーム状態は、このワーカーのアクティビティで判定する
+def game_idle_for(room_id):
+    game_state = game_store.get(room_id)
+    if game_state is None:
+        return 0.0  # 判定の間に終了した
+    if game_state.updated_at is None:
+        return sweeper.idle_for(room_id)
+    return time.time() - game_state.updated_at
+
+# 片付け: ゲーム中でなくなったルームのゲーム状態を削除し、GAME_IDLE_TTL 秒以上動きのないゲームを待機中に戻す
+# （ゲーム状態のないままゲーム中になっているルームも待機中に戻す）
+def sweep_game_states(batch):
+    ttl = app.config['GAME_IDLE_TTL']
+    room_ids = sweeper.next_batch('game_states', game_store.room_ids, batch)
+    statuses = dict(db.session.query(Room.id, Room.status).filter(Room.id.in_(room_ids))) if room_ids else {}
+    orphaned = [room_id for room_id in room_ids if statuses.get(room_id) != 'playing']
+    expired = [room_id for room_id in room_ids if room_id not in orphaned and game_idle_for(room_id) >= ttl]
+    playing = sweeper.next_page('playing_rooms',
+                                lambda after, limit: load_room_ids(after, limit, status='playing'), batch)
+    expired += [room_id for room_id in playing
+                if room_id not in expired and not game_store.exists(room_id) and sweeper.idle_for(room_id) >= ttl]
+    if expired:
+        Room.query.filter(Room.id.in_(expired), Room.status == 'playing').update(
+            {'status': 'waiting'}, synchronize_session=False)
+        db.session.commit()
+        lobby_cache.invalidate()
+    for room_id in orphaned + expired:
+        open_rooms.set_status(room_id, 'waiting')
+        scheduler.cancel(room_id)
+        with room_lock(room_id):
+            delete_game_state(room_id)
+    return {'game_states': len(orphaned), 'idle_games': len(expired)}
+
+# 片付け: どのカードからも参照されなくなった画像（元画像と縮小画像）を削除する
+def sweep_images(batch):
+    assets = ImageAsset.query.filter(ImageAsset.ref_count <= 0).limit(batch).all()
+    if not assets:
+        return {}
+    # 読み込んでから削除するまでの間に新しいルームが参照した画像は残す
+    # ファイルは行の削除をコミットする前に削除する（ルームの作成が参照数を加算した時点で、
+    # 行が残っていればファイルも残っており、行がなければファイルも削除済みになる）
+    deleted = 0
+    for asset in assets:
+        if ImageAsset.query.filter_by(hash=asset.hash).filter(ImageAsset.ref_count <= 0).delete(synchronize_session=False):
+            image_pipeline.remove_files(asset.filename, asset.variant)
+            deleted += 1
+    db.session.commit()
+    return {'images': deleted}
+
+# 片付け: 削除された画像を含むスプライトシートを削除する
+def sweep_sprites(batch):
+    return {'sprites': image_pipeline.remove_stale_sprites(sweeper.next_batch('sprites', image_pipeline.sprite_keys, batch))}
+
+# 片付け: 切断済みのSIDをキャッシュと対応表から削除する
+# （対応表はメモリのストアのみ。共有ストアの対応表には他のワーカーの接続も含まれる）
+def sweep_sids(batch):
+    is_connected = socketio.server.manager.is_connected
+    sids = 0
+    for sid in sweeper.next_batch('identity_sids', identity_cache.sids, batch):
+        if not is_connected(sid, '/') and identity_cache.pop(sid) is not None:
+            sids += 1
+    if app.config['GAME_STATE_BACKEND'] == 'memory':
+        for sid, user_id in sweeper.next_batch('store_sids', game_store.sid_bindings, batch):
+            if not is_connected(sid, '/') or game_store.get_sid(user_id) != sid:
+                game_store.unbind_sid(sid)
+                sids += 1
+    return {'sids': sids}
+
+# 片付け: 満タンに戻ったトークンバケットを削除する
+def sweep_rate_limits(batch):
+    return {'rate_buckets': sum(limiter.prune(sweeper.next_batch(name, limiter.keys, batch))
+                                for name, limiter in (('sid_buckets', admission.sids), ('room_buckets', admission.rooms)))}
+
+sweeper.add_step('rooms', sweep_idle_rooms)
+sweeper.add_step('game_states', sweep_game_states)
+sweeper.add_step('images', sweep_images)
+sweeper.add_step('sprites', sweep_sprites)
+sweeper.add_step('sids', sweep_sids)
+sweeper.add_step('rate_limits', sweep_rate_limits)
+
+# 片付けを1回実行し、次回を予約する（スケジューラから呼ばれる）
+@metrics.track_task('sweeper')
+def run_sweeper():
+    try:
+        with app.app_context():
+            sweeper.run_pass()
+    finally:
+        scheduler.schedule(sweeper.interval, 'sweeper', run_sweeper, background=True)
+
+# ジャーナルから、再起動前にゲーム中だったルームの状態を復元する
+# ・ゲーム状態を復元できないルームは待機中に戻す（ゲーム中のまま進められなくなるのを防ぐ）
+# ・未実行だった遅延処理（カードを裏返す、ゲーム終了）を予約し直す
+def recover_games():
+    started_at = time.perf_counter()
+    recovered = game_journal.recover(app.config['EVENT_LOG_SIZE'])
+    playing = {room_id for room_id, in db.session.query(Room.id).filter_by(status='playing')}
+    game_states = {room_id: game_state for room_id, game_state in recovered.items() if room_id in playing}
+    for room_id, game_state in game_states.items():
+        game_state.updated_at = time.time()  # 停止していた間は放置に数えない
+        game_store.save(room_id, game_state)
+        spectators.start(room_id, game_state)
+        local_rooms.add(room_id)
+        if game_state.is_complete():
+            scheduler.schedule(app.config['GAME_OVER_DELAY'], room_id, delayed_game_over, room_id, background=True)
+        elif len(game_state.flipped_cards) == 2:
+            user_id = game_state.current_turn
+            if isinstance(user_id, str):
+                user_id = next(uid for uid, name in game_state.player_names.items() if name == user_id)
+            card1_id, card2_id = game_state.flipped_cards
+            scheduler.schedule(game_state.flip_back_delay, room_id, reset_cards, room_id, card1_id, card2_id, user_id)
+    stuck = playing - game_states.keys()
+    if stuck:
+        Room.query.filter(Room.id.in_(stuck)).update({'status': 'waiting'})
+        db.session.commit()
+    game_journal.compact(game_states)
+    game_journal.start()
+    log.info('ジャーナルから %d ルームのゲーム状態を復元しました（待機中に戻したルーム: %d、%.3f 秒）',
+             len(game_states), len(stuck), time.perf_counter() - started_at)
+
+# ランキングを定期的に作り直す（スケジューラから呼ばれる）
+@metrics.track_task('refresh_leaderboard')
+def refresh_leaderboard():
+    try:
+        with app.app_context():
+            rebuild_leaderboard()
+    finally:
+        scheduler.schedule(app.config['LEADERBOARD_REFRESH'], 'leaderboard', refresh_leaderboard, background=True)
+
+# 拡張機能をアプリに登録する（DBのエンジン、Socket.IO、セッションの保存先。2回目以降は何もしない）
+def init_extensions():
+    if 'sqlalchemy' in app.extensions:
+        return
+    db.init_app(app)
+    socketio.init_app(app, ping_timeout=60, ping_interval=25, message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                      serializer='msgpack' if app.config['SOCKETIO_COMPACT'] else 'default')
+    app.session_interface = create_session_interface(app.config)
+    with app.app_context():
+        configure_sqlite(db.engine)
+
+# データベースの初期化（テーブルの作成、既存のDBのマイグレーション）
+# 起動時には行わないため、デプロイのたびに `flask --app app init-db` で実行する
+def init_db():
+    init_extensions()
+    with app.app_context():
+        db.create_all()
+        migrate(db.engine)
+
+# 起動時にスキーマを作成・更新する（作成は冪等。複数のワーカーが同時に作成して衝突した場合はやり直す）
+def create_schema(attempts=3):
+    for attempt in range(1, attempts + 1):
+        try:
+            init_db()
+            return
+        except DBAPIError:
+            if attempt == attempts:
+                raise
+            log.warning('スキーマの作成が他のワーカーと衝突しました。やり直します（%d/%d）', attempt, attempts)
+            time.sleep(attempt)
+
+@app.cli.command('init-db')
+def init_db_command():
+    init_db()
+    with app.app_context():
+        click.echo(f"データベースを初期化しました（スキーマのバージョン: {schema_version(db.engine)}）。")
+
+_created = False
+_create_lock = Lock()
+
+# アプリケーションのエントリーポイント（gunicorn では 'app:create_app()' を指定する）
+# ・モジュールの読み込みでは設定とルートの登録だけを行い、スレッドの開始やDBへの接続はしない
+#   （ワーカーを fork する前の親プロセスや、モジュールを読み込むだけのツールでは何も始めない）
+# ・ここでワーカーごとに1回、ログのスレッドの開始、拡張機能の登録、スキーマの確認、ゲームの復元、
+#   クイック参加の索引とランキングの作成、定期的な処理の予約を行う（2回目以降は同じアプリを返す）
+# ・SQLite のDBはワーカーのマシンのファイルで、release フェーズ（別のマシン）で作成したスキーマは見えないため、
+#   SQLite の場合とスキーマがまだない場合は、ここでスキーマを作成・更新する
+def create_app():
+    global _created
+    with _create_lock:
+        if _created:
+            return app
+        started_at = time.perf_counter()
+        configure_logging(app.config['LOG_LEVEL'], app.config['LOG_FORMAT'], app.config['LOG_SAMPLING'])
+        init_extensions()
+        with app.app_context():
+            if db.engine.dialect.name == 'sqlite' or schema_version(db.engine) is None:
+                create_schema()
+            check_schema(db.engine)
+            if game_journal:
+                recover_games()
+            open_rooms.rebuild((room_id, status, players) for room_id, _, status, players in load_lobby_rooms())
+            rebuild_leaderboard()
+        if sweeper.interval > 0:
+            scheduler.schedule(sweeper.interval, 'sweeper', run_sweeper, background=True)
+        if app.config['LEADERBOARD_REFRESH'] > 0:
+            scheduler.schedule(app.config['LEADERBOARD_REFRESH'], 'leaderboard', refresh_leaderboard, background=True)
+        _created = True
+        log.info('アプリケーションを初期化しました（%.3f 秒）', time.perf_counter() - started_at)
+        return app
 
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=False)
\ No newline at end of file
+    init_db()  # 開発用: 直接実行した場合はスキーマも作成する
+    socketio.run(create_app(), host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=False)
\ No newline at end of file
@@ -0,0 +1,96 @@
+# benchmarks/bench_deck.py
+#
+# 大きなデッキのゲーム画面の表示を計測するベンチマーク
+# ・一時ディレクトリのDBとアップロード先を使い、アプリをプロセス内で動かす
+# ・ゲームを開始したルームについて、以下を表示する
+#   - GET /game の所要時間とHTMLの大きさ、処理中に確保したメモリの最大値（tracemalloc）
+#     （最初のページのカードはHTMLに埋め込まれるため、操作できるようになるまでの時間の目安）
+#   - /game/<room_id>/cards で残りの配置を全て取得した場合の所要時間とリクエスト数
+#
+# 使い方:
+#   python benchmarks/bench_deck.py --cards 1000 --repeat 5
+
+import argparse
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_storage import make_image
+
+
+def main():
+    parser = argparse.ArgumentParser(description='大きなデッキのゲーム画面のベンチマーク')
+    parser.add_argument('--cards', type=int, default=1000, help='デッキのカード枚数（2枚で1組）')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ss-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('DECK_SPRITES', '0')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.chdir(workdir)  # アップロード先（static/images）を一時ディレクトリに作る
+
+    import app as ss
+    ss.init_db()
+    ss.create_app()
+
+    images = [make_image(i) for i in range(args.cards // 2)]
+    creator = ss.app.test_client()
+    other = ss.app.test_client()
+    creator.post('/set_username', data={'username': 'bench-creator'})
+    other.post('/set_username', data={'username': 'bench-player'})
+    creator.set_cookie('username', 'bench-creator')
+    other.set_cookie('username', 'bench-player')
+    resp = creator.post('/create_room', content_type='multipart/form-data', data={
+        'room_name': 'bench-deck',
+        'card_name': [f"card{i}" for i in range(len(images))],
+        'card_image': [(io.BytesIO(img), f"card{i}.png") for i, img in enumerate(images)],
+    })
+    assert resp.status_code == 302, resp.status_code
+    with ss.app.app_context():
+        room_id = ss.Room.query.filter_by(name='bench-deck').first().id
+    other.post(f"/join_room/{room_id}")
+    resp = creator.post(f"/start_game/{room_id}")
+    assert resp.status_code == 302, resp.status_code
+
+    page_times, page_peaks, layout_times = [], [], []
+    html_size = layout_requests = 0
+    for _ in range(args.repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        resp = creator.get(f"/game/{room_id}")
+        page_times.append(time.perf_counter() - start)
+        page_peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert resp.status_code == 200, resp.status_code
+        html_size = len(resp.data)
+
+        # 残りの配置をページ単位で取得する（配置のエンドポイントがない場合は計測しない）
+        after = ss.app.config.get('CARD_PAGE_SIZE')
+        if after is None:
+            continue
+        layout_requests = 0
+        start = time.perf_counter()
+        while after is not None:
+            data = creator.get(f"/game/{room_id}/cards?after={after}").get_json()
+            layout_requests += 1
+            after = data['next']
+        layout_times.append(time.perf_counter() - start)
+
+    ss.image_pipeline.shutdown()
+    print(f"cards={args.cards}")
+    print(f"GET /game  median={statistics.median(page_times) * 1000:.1f}ms html={html_size / 1024:.1f}KiB "
+          f"peak memory={statistics.median(page_peaks) / 1024:.0f}KiB")
+    if layout_times:
+        print(f"layout     median={statistics.median(layout_times) * 1000:.1f}ms requests={layout_requests}")
+
+
+if __name__ == '__main__':
+    main()
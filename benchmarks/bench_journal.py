@@ -0,0 +1,98 @@
+# benchmarks/bench_journal.py
+#
+# ゲーム状態のジャーナルのベンチマーク
+# ・ルームごとにスナップショットとカードめくりのイベントを追記し、1回の追記にかかる時間を計測する
+#   （追記はキューに入れるだけなので、flip_card の処理時間にはこの分だけが加わる）
+# ・書き込みスレッドの fsync の回数（グループコミットでまとめられた回数）を表示する
+# ・ジャーナルから全ルームのゲーム状態を復元する時間と、詰め直す時間を計測する
+#
+# 使い方:
+#   python benchmarks/bench_journal.py --rooms 10000 --events 40
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game_state import GameState
+from journal import GameJournal
+
+
+Card = namedtuple('Card', ['id', 'name', 'image'])
+
+
+def new_game_state(num_cards):
+    return GameState.from_cards([Card(i + 1, f"card{i // 2}", f"card{i // 2}.png") for i in range(num_cards)],
+                                current_turn=1, players=[1, 2], player_names={1: 'p1', 2: 'p2'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ゲーム状態のジャーナルのベンチマーク')
+    parser.add_argument('--rooms', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=40, help='ルームあたりのイベント数')
+    parser.add_argument('--cards', type=int, default=40)
+    parser.add_argument('--snapshot-every', type=int, default=100)
+    parser.add_argument('--no-fsync', action='store_true')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='ss-bench-'), 'journal.jsonl')
+    journal = GameJournal(path, fsync=not args.no_fsync, snapshot_every=args.snapshot_every)
+    journal.start()
+
+    states = {room_id: new_game_state(args.cards) for room_id in range(1, args.rooms + 1)}
+    for room_id, game_state in states.items():
+        journal.snapshot(room_id, game_state)
+
+    # カードを1枚ずつめくって裏返す（flip_card と cards_reset の繰り返し）
+    samples = []
+    for i in range(args.events // 2):
+        for room_id, game_state in states.items():
+            card_id = i % args.cards + 1
+            game_state.flip(card_id)
+            data = game_state.record_event('card_flipped', {'card_id': str(card_id)})
+            start = time.perf_counter()
+            journal.append(room_id, game_state.seq, 'card_flipped', data)
+            samples.append(time.perf_counter() - start)
+            game_state.unflip(card_id)
+            game_state.flipped_cards = []
+            data = game_state.record_event('cards_reset', {'card1_id': card_id, 'card2_id': card_id})
+            journal.append(room_id, game_state.seq, 'cards_reset', data)
+            journal.maybe_snapshot(room_id, game_state)
+
+    start = time.perf_counter()
+    journal.close()
+    drain = time.perf_counter() - start
+    size = os.path.getsize(path)
+
+    start = time.perf_counter()
+    recovered = GameJournal(path).recover()
+    recover_time = time.perf_counter() - start
+    assert len(recovered) == args.rooms
+    for room_id, game_state in states.items():
+        assert recovered[room_id].seq == game_state.seq
+        assert recovered[room_id].flipped == game_state.flipped
+
+    start = time.perf_counter()
+    GameJournal(path).compact(recovered)
+    compact_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    GameJournal(path).recover()
+    recover_compacted_time = time.perf_counter() - start
+
+    samples.sort()
+    print(f"rooms={args.rooms} events/room={args.events} records={journal.appended} "
+          f"commits={journal.commits} file={size / 1024 / 1024:.1f}MiB")
+    print(f"append p50={statistics.median(samples) * 1e6:.2f}us p99={samples[int(len(samples) * 0.99)] * 1e6:.2f}us "
+          f"(drain after last append {drain:.2f}s)")
+    print(f"recover={recover_time:.2f}s compact={compact_time:.2f}s "
+          f"compacted file={os.path.getsize(path) / 1024 / 1024:.1f}MiB recover(compacted)={recover_compacted_time:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
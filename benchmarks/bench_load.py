@@ -0,0 +1,205 @@
+# benchmarks/bench_load.py
+#
+# 複数ルームの負荷試験（N ルーム x M プレイヤー）
+# ・一時ディレクトリのDBとアップロード先を使い、アプリをプロセス内で動かす
+# ・/set_username でユーザーを登録し、生成した画像で /create_room、/join_room、/start_game を行う
+# ・Socket.IO のテストクライアントで join_game のあと、ルームごとのプレイヤーが順番に flip_card を送る
+# ・以下を表示する
+#   - flip_card を送ってから他のプレイヤーに card_flipped が届くまでの時間（p50 / p99）
+#   - 1秒あたりの flip_card の数と、プレイヤーに届いたイベントとフレーム（まとめて送られたものは1つ）の数
+#   - ルームあたりのメモリ（ゲーム開始から join_game までに確保されたメモリ、tracemalloc）
+#   - イベントあたりのDBクエリ数（/db_stats と同じ集計）
+#
+# 使い方:
+#   python benchmarks/bench_load.py --rooms 50 --players 4 --cards 20 --duration 10
+
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_storage import make_image
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='複数ルームの負荷試験')
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--players', type=int, default=4, help='ルームあたりのプレイヤー数')
+    parser.add_argument('--cards', type=int, default=20, help='デッキのカード枚数（2枚で1組）')
+    parser.add_argument('--duration', type=float, default=10.0, help='最大の実行時間（秒）')
+    parser.add_argument('--match-rate', type=float, default=0.5, help='めくった2枚が一致する確率')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix='ss-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('DECK_SPRITES', '0')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.chdir(workdir)  # アップロード先（static/images）を一時ディレクトリに作る
+
+    import app as ss
+    ss.init_db()
+    app, socketio = ss.create_app(), ss.socketio
+
+    def client(name):
+        c = app.test_client()
+        resp = c.post('/set_username', data={'username': name})
+        assert resp.status_code == 302, resp.status_code
+        c.set_cookie('username', name)
+        return c
+
+    # ルームの作成と参加
+    images = [make_image(i) for i in range(args.cards // 2)]
+    rooms = []
+    for r in range(args.rooms):
+        names = [f"r{r}p{p}" for p in range(args.players)]
+        http = [client(name) for name in names]
+        resp = http[0].post('/create_room', content_type='multipart/form-data', data={
+            'room_name': f"load-{r}",
+            'card_name': [f"card{i}" for i in range(len(images))],
+            'card_image': [(io.BytesIO(img), f"card{i}.png") for i, img in enumerate(images)],
+        })
+        assert resp.status_code == 302, resp.status_code
+        with app.app_context():
+            room_id = ss.Room.query.filter_by(name=f"load-{r}").first().id
+            cards = ss.Card.query.filter_by(room_id=room_id).all()
+        for c in http[1:]:
+            c.post(f"/join_room/{room_id}")
+        partner = {}
+        by_name = {}
+        for card in cards:
+            by_name.setdefault(card.name, []).append(card.id)
+        for a, b in by_name.values():
+            partner[a], partner[b] = b, a
+        rooms.append({'id': room_id, 'names': names, 'http': http, 'partner': partner})
+
+    # ゲーム開始と join_game（この間に確保されたメモリをルーム数で割る）
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    for room in rooms:
+        resp = room['http'][0].post(f"/start_game/{room['id']}", data={'flip_back_delay': 0.3})
+        assert resp.status_code == 302, resp.status_code
+        room['sio'] = {}
+        for name, c in zip(room['names'], room['http']):
+            sio = socketio.test_client(app, flask_test_client=c)
+            sio.emit('join_game', {'room': room['id'], 'username': name})
+            room['sio'][name] = sio
+    mem_per_room = (tracemalloc.get_traced_memory()[0] - mem_before) / len(rooms)
+    tracemalloc.stop()
+
+    before = ss.query_counter.snapshot()
+    latencies = []
+    stats = {'flips': 0, 'frames': 0, 'received': 0, 'games_over': 0, 'running': len(rooms)}
+    deadline = time.perf_counter() + args.duration
+
+    # ルームのプレイヤーを順番に操作する（1ルームにつき1つのグリーンスレッド）
+    def play(room):
+        state = {'turn': room['names'][0], 'seq': 0, 'over': False}
+        remaining = set(room['partner'])
+
+        # 同じイベントは全員に届くので、連番で1回だけ処理する
+        # （まとめて送られた 'game_events' は個々のイベントに分けて処理し、イベントの一覧を返す）
+        def handle(messages):
+            stats['frames'] += len(messages)
+            events = []
+            for message in messages:
+                data = message['args'][0] if message['args'] else {}
+                if message['name'] == 'game_events':
+                    events.extend((e['event'], e['data']) for e in data['events'])
+                else:
+                    events.append((message['name'], data))
+            stats['received'] += len(events)
+            for event, data in events:
+                if event == 'game_over':
+                    state['over'] = True
+                if 'seq' in data and data['seq'] > state['seq']:
+                    state['seq'] = data['seq']
+                    if event == 'turn_changed':
+                        state['turn'] = data['current_turn']
+            return events
+
+        def drain():
+            for sio in room['sio'].values():
+                handle(sio.get_received())
+
+        def flip(name, card_id):
+            observer = next(sio for other, sio in room['sio'].items() if other != name)
+            start = time.perf_counter()
+            room['sio'][name].emit('flip_card', {'room': room['id'], 'card_id': str(card_id), 'username': name})
+            while True:
+                events = handle(observer.get_received())
+                if any(event == 'card_flipped' and data['card_id'] == card_id for event, data in events):
+                    latencies.append(time.perf_counter() - start)
+                    break
+                socketio.sleep(0)
+            stats['flips'] += 1
+
+        while remaining and time.perf_counter() < deadline:
+            name = state['turn']
+            card1 = random.choice(tuple(remaining))
+            if random.random() < args.match_rate or len(remaining) == 2:
+                card2 = room['partner'][card1]
+            else:
+                card2 = random.choice(tuple(remaining - {card1, room['partner'][card1]}))
+            flip(name, card1)
+            flip(name, card2)
+            if card2 == room['partner'][card1]:
+                remaining -= {card1, card2}
+                continue
+            # マッチ失敗: ターンが交代するまで待つ
+            turn = name
+            while state['turn'] == turn and time.perf_counter() < deadline:
+                socketio.sleep(0.01)
+                drain()
+        while not remaining and not state['over'] and time.perf_counter() < deadline:
+            socketio.sleep(0.05)
+            drain()
+        if state['over']:
+            stats['games_over'] += 1
+
+    def run(room):
+        try:
+            play(room)
+        finally:
+            stats['running'] -= 1
+
+    start = time.perf_counter()
+    for room in rooms:
+        socketio.start_background_task(run, room)
+    # モンキーパッチなしでは join() で待てないため、全ルームが終わるまでハブに処理を譲る
+    while stats['running']:
+        socketio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    after = ss.query_counter.snapshot()
+    events = sum(after[e]['events'] - before.get(e, {}).get('events', 0) for e in after)
+    queries = sum(after[e]['queries'] - before.get(e, {}).get('queries', 0) for e in after)
+
+    ss.image_pipeline.shutdown()
+    print(f"rooms={args.rooms} players={args.players} cards={args.cards} elapsed={elapsed:.2f}s "
+          f"games_over={stats['games_over']}")
+    print(f"flip -> card_flipped  p50={percentile(latencies, 50) * 1000:.2f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.2f}ms (n={len(latencies)})")
+    print(f"flip_card/s={stats['flips'] / elapsed:.0f} received events/s={stats['received'] / elapsed:.0f} "
+          f"frames/s={stats['frames'] / elapsed:.0f}")
+    print(f"memory/room={mem_per_room / 1024:.1f}KiB")
+    print(f"db queries/event={queries / events if events else 0.0:.3f} (socket events={events})")
+
+
+if __name__ == '__main__':
+    main()
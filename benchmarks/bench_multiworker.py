@@ -0,0 +1,98 @@
+# benchmarks/bench_multiworker.py
+#
+# 共有ゲーム状態ストア（Redis）を複数ワーカーから同時に操作するベンチマーク
+# ・各ワーカー（プロセス）が全ルームに対してカードめくりを行う
+#   （同じルームのプレイヤーが別々のワーカーに接続している状況を再現）
+# ・終了後、各ルームのめくり回数がワーカーの実行回数の合計と一致するか確認する
+# ・ワーカー数を増やしたときの合計スループットを表示する
+#
+# 使い方:
+#   python benchmarks/bench_multiworker.py --redis-url redis://localhost:6379/15 --workers 1 2 4
+
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game_state import GameState
+from game_store import RedisGameStateStore
+
+
+def new_game_state(num_cards):
+    return GameState(list(range(num_cards)), [i // 2 for i in range(num_cards)],
+                     [f"card{i}" for i in range(num_cards // 2)], 1, [1, 2], {1: 'p1', 2: 'p2'})
+
+
+def worker(redis_url, prefix, room_ids, flips, num_cards, result_queue):
+    store = RedisGameStateStore(redis_url, prefix=prefix)
+    done = 0
+    start = time.perf_counter()
+    for i in range(flips):
+        room_id = room_ids[i % len(room_ids)]
+        with store.lock(room_id):
+            game_state = store.get(room_id)
+            card_id = i % num_cards
+            if game_state.is_flipped(card_id):
+                game_state.unflip(card_id)
+            else:
+                game_state.flip(card_id)
+                game_state.flipped_cards = []
+            game_state.scores[1] += 1  # めくり回数として数える
+            store.save(room_id, game_state)
+        done += 1
+    result_queue.put((done, time.perf_counter() - start))
+
+
+def run(redis_url, num_workers, num_rooms, flips, num_cards):
+    prefix = f"ssbench{os.getpid()}:"
+    store = RedisGameStateStore(redis_url, prefix=prefix)
+    room_ids = list(range(1, num_rooms + 1))
+    for room_id in room_ids:
+        store.save(room_id, new_game_state(num_cards))
+
+    result_queue = Queue()
+    processes = [Process(target=worker, args=(redis_url, prefix, room_ids, flips, num_cards, result_queue))
+                 for _ in range(num_workers)]
+    start = time.perf_counter()
+    for p in processes:
+        p.start()
+    results = [result_queue.get() for _ in processes]
+    for p in processes:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    # 一貫性チェック: 更新の取りこぼしがないこと
+    total_done = sum(done for done, _ in results)
+    total_recorded = sum(store.get(room_id).scores[1] for room_id in room_ids)
+    for room_id in room_ids:
+        store.delete(room_id)
+
+    return {
+        'workers': num_workers,
+        'flips': total_done,
+        'elapsed': elapsed,
+        'throughput': total_done / elapsed,
+        'consistent': total_done == total_recorded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='共有ゲーム状態ストアのマルチワーカーベンチマーク')
+    parser.add_argument('--redis-url', default=os.environ.get('REDIS_URL', 'redis://localhost:6379/15'))
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--flips', type=int, default=2000, help='ワーカーごとのめくり回数')
+    parser.add_argument('--cards', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'flips':>8} {'elapsed(s)':>11} {'flips/s':>10} consistent")
+    for num_workers in args.workers:
+        r = run(args.redis_url, num_workers, args.rooms, args.flips, args.cards)
+        print(f"{r['workers']:>8} {r['flips']:>8} {r['elapsed']:>11.3f} {r['throughput']:>10.1f} {r['consistent']}")
+
+
+if __name__ == '__main__':
+    main()
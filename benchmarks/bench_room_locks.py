@@ -0,0 +1,76 @@
+# benchmarks/bench_room_locks.py
+#
+# ルームごとのロックでのカードめくりのレイテンシを、同時に進行するルーム数を変えて計測する
+# ・各ルームに1スレッドを割り当て、ロックを取ってゲーム状態を更新する
+# ・ロック中の処理時間（emitなど）は --hold-ms で模擬する
+# ・--global-lock を指定すると、以前の全ルーム共通ロックと比較できる
+#
+# 使い方:
+#   python benchmarks/bench_room_locks.py --rooms 1 10 50 100
+#   python benchmarks/bench_room_locks.py --rooms 1 10 50 100 --global-lock
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game_store import MemoryGameStateStore
+
+
+def run(num_rooms, flips, hold, global_lock):
+    store = MemoryGameStateStore()
+    shared_lock = threading.Lock()
+    for room_id in range(num_rooms):
+        with store.lock(room_id):
+            store.save(room_id, {'flip_count': 0})
+
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def player(room_id):
+        samples = []
+        for _ in range(flips):
+            start = time.perf_counter()
+            with (shared_lock if global_lock else store.lock(room_id)):
+                game_state = store.get(room_id)
+                game_state['flip_count'] += 1
+                time.sleep(hold)
+                store.save(room_id, game_state)
+            samples.append(time.perf_counter() - start)
+        with latencies_lock:
+            latencies.extend(samples)
+
+    threads = [threading.Thread(target=player, args=(room_id,)) for room_id in range(num_rooms)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    return {
+        'rooms': num_rooms,
+        'p50': statistics.median(latencies) * 1000,
+        'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ルームごとのロックのレイテンシベンチマーク')
+    parser.add_argument('--rooms', type=int, nargs='+', default=[1, 10, 50, 100])
+    parser.add_argument('--flips', type=int, default=50, help='ルームごとのめくり回数')
+    parser.add_argument('--hold-ms', type=float, default=1.0, help='ロック中の処理時間（ミリ秒）')
+    parser.add_argument('--global-lock', action='store_true', help='全ルーム共通のロックを使う')
+    args = parser.parse_args()
+
+    print(f"{'rooms':>6} {'p50(ms)':>9} {'p99(ms)':>9}")
+    for num_rooms in args.rooms:
+        r = run(num_rooms, args.flips, args.hold_ms / 1000, args.global_lock)
+        print(f"{r['rooms']:>6} {r['p50']:>9.2f} {r['p99']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# benchmarks/bench_startup.py
+#
+# ワーカーの起動時間（コールドスタート）を計測するベンチマーク
+# ・毎回新しいプロセスで、一時ディレクトリのDBとアップロード先を使ってアプリを読み込む
+# ・以下を表示する
+#   - import: app モジュールの読み込み（ワーカーを fork する前に親プロセスで行う部分）
+#   - create_app: DBへの接続、ゲームの復元などの起動処理
+#   - first request: 最初のリクエスト（GET /metrics）の応答まで
+#   - total: プロセスの起動から最初の応答まで
+# ・--rooms を指定すると、その数のルームとユーザーがあるDBで計測する
+#
+# 使い方:
+#   python benchmarks/bench_startup.py --repeat 10 --rooms 1000
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子プロセスで実行する計測用のスクリプト
+CHILD = r'''
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app as ss
+imported = time.perf_counter()
+application = ss.create_app() if hasattr(ss, 'create_app') else ss.app
+created = time.perf_counter()
+resp = application.test_client().get('/metrics')
+assert resp.status_code == 200, resp.status_code
+done = time.perf_counter()
+print(json.dumps({'import': imported - started, 'create_app': created - imported, 'first_request': done - created}))
+'''
+
+# ルームとユーザーのあるDBを作る（スキーマの作成はこの時点で済ませておく）
+SEED = r'''
+import sys
+sys.path.insert(0, sys.argv[1])
+import app as ss
+rooms = int(sys.argv[2])
+with ss.app.app_context():
+    if hasattr(ss, 'init_db'):
+        ss.init_db()
+    ss.db.session.execute(ss.insert(ss.User), [{'name': f"user{i}", 'score': i % 50} for i in range(rooms * 2)])
+    ss.db.session.execute(ss.insert(ss.Room), [{'name': f"room{i}", 'creator_id': i * 2 + 1} for i in range(rooms)])
+    ss.db.session.commit()
+'''
+
+
+def run(script, *args, env, cwd):
+    return subprocess.run([sys.executable, '-c', script, ROOT, *map(str, args)], env=env, cwd=cwd,
+                          check=True, capture_output=True, text=True).stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ワーカーの起動時間のベンチマーク')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--rooms', type=int, default=0, help='事前に作成しておくルーム数')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ss-bench-')
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+               LOG_LEVEL='WARNING',
+               SWEEP_INTERVAL='0')
+    try:
+        run(SEED, args.rooms, env=env, cwd=workdir)
+        samples = {'import': [], 'create_app': [], 'first_request': [], 'total': []}
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = json.loads(run(CHILD, env=env, cwd=workdir).strip().splitlines()[-1])
+            result['total'] = time.perf_counter() - start
+            for key, value in result.items():
+                samples[key].append(value)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"rooms={args.rooms} repeat={args.repeat}")
+    for key, values in samples.items():
+        print(f"{key:<14} median={statistics.median(values) * 1000:.1f}ms max={max(values) * 1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# benchmarks/bench_storage.py
+#
+# ルーム作成とゲーム開始のDB負荷を計測するベンチマーク（大きなデッキ）
+# ・一時ディレクトリのDBとアップロード先を使い、アプリをプロセス内で動かす
+# ・リクエストごとの所要時間、SQL文の数、コミット（書き込みトランザクション）の数を表示する
+#
+# 使い方:
+#   python benchmarks/bench_storage.py --cards 1000 --rooms 5
+
+import argparse
+import io
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def make_image(i):
+    try:
+        from PIL import Image
+    except ImportError:
+        return b'\x89PNG\r\n\x1a\n' + i.to_bytes(4, 'big')
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 64), (i % 256, (i // 256) % 256, 128)).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ルーム作成とゲーム開始のDBベンチマーク')
+    parser.add_argument('--cards', type=int, default=1000, help='デッキのカード枚数（2枚で1組）')
+    parser.add_argument('--rooms', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ss-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('DECK_SPRITES', '0')
+    os.chdir(workdir)  # アップロード先（static/images）を一時ディレクトリに作る
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    import app as ss
+    ss.init_db()
+    ss.create_app()
+
+    # リクエストを処理しているスレッドの分だけ数える（画像のワーカースレッドの書き込みは除く）
+    main_thread = threading.get_ident()
+    counts = {'statements': 0, 'commits': 0}
+
+    def count(key):
+        def listener(*args):
+            if threading.get_ident() == main_thread:
+                counts[key] += 1
+        return listener
+
+    event.listen(Engine, 'before_cursor_execute', count('statements'))
+    event.listen(Engine, 'commit', count('commits'))
+
+    def measure(f):
+        counts['statements'] = counts['commits'] = 0
+        start = time.perf_counter()
+        resp = f()
+        assert resp.status_code == 302, resp.status_code
+        return time.perf_counter() - start, counts['statements'], counts['commits']
+
+    images = [make_image(i) for i in range(args.cards // 2)]
+    creator = ss.app.test_client()
+    other = ss.app.test_client()
+    creator.post('/set_username', data={'username': 'bench-creator'})
+    other.post('/set_username', data={'username': 'bench-player'})
+    creator.set_cookie('username', 'bench-creator')
+    other.set_cookie('username', 'bench-player')
+
+    results = {'create_room': [], 'start_game': []}
+    for n in range(args.rooms):
+        room_name = f"bench-{n}"
+        data = {
+            'room_name': room_name,
+            'card_name': [f"card{i}" for i in range(len(images))],
+            'card_image': [(io.BytesIO(img), f"card{i}.png") for i, img in enumerate(images)],
+        }
+        results['create_room'].append(measure(
+            lambda: creator.post('/create_room', data=data, content_type='multipart/form-data')))
+        with ss.app.app_context():
+            room_id = ss.Room.query.filter_by(name=room_name).first().id
+        other.post(f"/join_room/{room_id}")
+        results['start_game'].append(measure(lambda: creator.post(f"/start_game/{room_id}")))
+        # 次のルームを作れるようにゲームを終わらせて退出させる
+        with ss.app.app_context():
+            ss.User.query.update({'room_id': None})
+            ss.Room.query.filter_by(id=room_id).update({'status': 'waiting'})
+            ss.db.session.commit()
+
+    ss.image_pipeline.shutdown()
+    print(f"{'request':>12} {'median(ms)':>11} {'statements':>11} {'commits':>8}")
+    for name, samples in results.items():
+        print(f"{name:>12} {statistics.median(s[0] for s in samples) * 1000:>11.1f} "
+              f"{statistics.median(s[1] for s in samples):>11.0f} {statistics.median(s[2] for s in samples):>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
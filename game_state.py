@@ -0,0 +1,216 @@
+# game_state.py
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+
+# 1ルーム分のゲーム状態
+# ・カードはシャッフル後の並び順（位置 - 1）をインデックスとした配列で持つ
+# ・めくり/マッチのフラグは bytearray、カードの組は名前ではなく小さな整数（ペアID）で比較する
+# ・マッチしたペア数を数えておき、ゲーム終了の判定を O(1) で行う
+# ・ルームへのイベントには連番（seq）を付け、直近のものをリングバッファに残して再接続時の差分に使う
+class GameState:
+    __slots__ = (
+        'card_ids',        # array('q'): インデックス -> カードID
+        'sorted_ids',      # array('q'): カードIDの昇順（検索用）
+        'sorted_index',    # array('I'): sorted_ids と同じ順のインデックス
+        'pair_ids',        # array('I'): インデックス -> ペアID
+        'pair_names',      # list: ペアID -> カード名
+        'pair_images',     # list: ペアID -> カード画像のファイル名（観戦者に表になったカードを見せる用）
+        'flipped',         # bytearray: インデックス -> めくられているか
+        'matched',         # bytearray: インデックス -> マッチ済みか
+        'matched_pairs',   # int: マッチしたペア数
+        'current_turn',
+        'players',
+        'player_names',
+        'scores',
+        'flipped_cards',
+        'flip_back_delay', # float: マッチ失敗時にカードを裏返すまでの秒数（ルームごと）
+        'seq',             # int: 最後に送信したイベントの連番
+        'event_log',       # deque: 直近のイベント (seq, イベント名, データ)
+        'updated_at',      # float: 最後に保存した時刻（UNIX時間。全ワーカーで共通の、放置されたゲームの判定用）
+    )
+
+    def __init__(self, card_ids, pair_ids, pair_names, current_turn, players, player_names, pair_images=None, scores=None,
+                 flipped=None, matched=None, flipped_cards=None, flip_back_delay=1.0,
+                 seq=0, event_log=(), event_log_size=64, updated_at=None):
+        n = len(card_ids)
+        self.card_ids = array('q', card_ids)
+        order = sorted(range(n), key=card_ids.__getitem__)
+        self.sorted_ids = array('q', (card_ids[i] for i in order))
+        self.sorted_index = array('I', order)
+        self.pair_ids = array('I', pair_ids)
+        self.pair_names = list(pair_names)
+        self.pair_images = list(pair_images) if pair_images is not None else [None] * len(self.pair_names)
+        self.flipped = bytearray(flipped) if flipped is not None else bytearray(n)
+        self.matched = bytearray(matched) if matched is not None else bytearray(n)
+        self.matched_pairs = sum(self.matched) // 2
+        self.current_turn = current_turn
+        self.players = list(players)
+        self.player_names = dict(player_names)
+        self.scores = dict(scores) if scores is not None else {user_id: 0 for user_id in self.players}
+        self.flipped_cards = list(flipped_cards) if flipped_cards is not None else []
+        self.flip_back_delay = flip_back_delay
+        self.seq = seq
+        self.event_log = deque((tuple(e) for e in event_log), maxlen=event_log_size)
+        self.updated_at = updated_at
+
+    # 並び順のカード（id, name, image を持つオブジェクト）から作成する
+    @classmethod
+    def from_cards(cls, cards, current_turn, players, player_names, flip_back_delay=1.0, event_log_size=64):
+        pair_id_of = {}
+        pair_ids = []
+        pair_images = []
+        for card in cards:
+            if card.name not in pair_id_of:
+                pair_id_of[card.name] = len(pair_id_of)
+                pair_images.append(card.image)
+            pair_ids.append(pair_id_of[card.name])
+        return cls([card.id for card in cards], pair_ids, list(pair_id_of), current_turn, players, player_names,
+                   pair_images=pair_images, flip_back_delay=flip_back_delay, event_log_size=event_log_size)
+
+    def __len__(self):
+        return len(self.card_ids)
+
+    def index_of(self, card_id):
+        i = bisect_left(self.sorted_ids, card_id)
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == card_id:
+            return self.sorted_index[i]
+        return None
+
+    def has_card(self, card_id):
+        return self.index_of(card_id) is not None
+
+    def position(self, card_id):
+        return self.index_of(card_id) + 1
+
+    def name(self, card_id):
+        return self.pair_names[self.pair_ids[self.index_of(card_id)]]
+
+    def is_flipped(self, card_id):
+        return bool(self.flipped[self.index_of(card_id)])
+
+    def is_matched(self, card_id):
+        return bool(self.matched[self.index_of(card_id)])
+
+    def flip(self, card_id):
+        self.flipped[self.index_of(card_id)] = 1
+        self.flipped_cards.append(card_id)
+
+    def unflip(self, card_id):
+        self.flipped[self.index_of(card_id)] = 0
+
+    def is_pair(self, card1_id, card2_id):
+        return self.pair_ids[self.index_of(card1_id)] == self.pair_ids[self.index_of(card2_id)]
+
+    def mark_matched(self, card1_id, card2_id):
+        self.matched[self.index_of(card1_id)] = 1
+        self.matched[self.index_of(card2_id)] = 1
+        self.matched_pairs += 1
+
+    def is_complete(self):
+        return self.matched_pairs * 2 >= len(self.card_ids)
+
+    # イベントに連番を付けて記録し、送信するデータを返す
+    def record_event(self, event, data):
+        self.seq += 1
+        data['seq'] = self.seq
+        self.event_log.append((self.seq, event, data))
+        return data
+
+    # 記録済みのイベントを状態に反映する（ジャーナルからの復元用）
+    def apply_event(self, seq, event, data):
+        if event == 'card_flipped':
+            self.flip(int(data['card_id']))
+        elif event == 'match_result':
+            self.mark_matched(data['card1_id'], data['card2_id'])
+            self.scores = {int(user_id): score for user_id, score in data['scores'].items()}
+            self.flipped_cards = []
+        elif event == 'cards_reset':
+            self.unflip(data['card1_id'])
+            self.unflip(data['card2_id'])
+            self.flipped_cards = []
+        elif event == 'turn_changed':
+            self.current_turn = data['current_turn']
+            self.flipped_cards = []
+        self.seq = seq
+        self.event_log.append((seq, event, data))
+
+    # last_seq より後のイベントの一覧。バッファから溢れていて差分を作れない場合は None
+    def events_since(self, last_seq):
+        if last_seq > self.seq:
+            return None
+        if last_seq == self.seq:
+            return []
+        if not self.event_log or self.event_log[0][0] > last_seq + 1:
+            return None
+        return [{'event': event, 'data': data} for seq, event, data in self.event_log if seq > last_seq]
+
+    # 送信用のスコア（キーは文字列。msgpack でも JSON と同じ形になるようにする）
+    def scores_payload(self):
+        return {str(user_id): score for user_id, score in self.scores.items()}
+
+    # クライアントに送る 'game_state' の形式
+    # redact=True の場合、表になっていないカードの名前は含めない
+    def to_payload(self, redact=False):
+        cards = {}
+        for i, card_id in enumerate(self.card_ids):
+            card = {
+                'is_flipped': bool(self.flipped[i]),
+                'is_matched': bool(self.matched[i]),
+                'position': i + 1,
+            }
+            if not redact or card['is_flipped'] or card['is_matched']:
+                card['name'] = self.pair_names[self.pair_ids[i]]
+            cards[str(card_id)] = card
+        return {
+            'cards': cards,
+            'current_turn': self.current_turn,
+            'players': self.players,
+            'scores': self.scores_payload(),
+            'flipped_cards': self.flipped_cards,
+            'seq': self.seq,
+        }
+
+    # 共有ストアに保存するための形式（JSONにできる値のみ）
+    def to_dict(self):
+        return {
+            'card_ids': self.card_ids.tolist(),
+            'pair_ids': self.pair_ids.tolist(),
+            'pair_names': self.pair_names,
+            'pair_images': self.pair_images,
+            'flipped': self.flipped.hex(),
+            'matched': self.matched.hex(),
+            'current_turn': self.current_turn,
+            'players': self.players,
+            'player_names': [[user_id, name] for user_id, name in self.player_names.items()],
+            'scores': [[user_id, score] for user_id, score in self.scores.items()],
+            'flipped_cards': self.flipped_cards,
+            'flip_back_delay': self.flip_back_delay,
+            'seq': self.seq,
+            'event_log': list(self.event_log),
+            'event_log_size': self.event_log.maxlen,
+            'updated_at': self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['card_ids'],
+            data['pair_ids'],
+            data['pair_names'],
+            data['current_turn'],
+            data['players'],
+            dict(data['player_names']),
+            pair_images=data.get('pair_images'),
+            scores=dict(data['scores']),
+            flipped=bytes.fromhex(data['flipped']),
+            matched=bytes.fromhex(data['matched']),
+            flipped_cards=data['flipped_cards'],
+            flip_back_delay=data.get('flip_back_delay', 1.0),
+            seq=data.get('seq', 0),
+            event_log=data.get('event_log', ()),
+            event_log_size=data.get('event_log_size', 64),
+            updated_at=data.get('updated_at'),
+        )
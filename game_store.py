@@ -0,0 +1,241 @@
+# game_store.py
+
+import json
+from threading import Lock
+
+from game_state import GameState
+
+
+# ゲーム状態の保存先のインターフェース
+# ・ゲーム状態は get() で取得し、変更後は save() で書き戻す
+# ・読み込みから書き戻しまでは lock(room_id) の中で行う
+class GameStateStore:
+    def get(self, room_id):
+        raise NotImplementedError
+
+    def save(self, room_id, game_state):
+        raise NotImplementedError
+
+    def delete(self, room_id):
+        raise NotImplementedError
+
+    def exists(self, room_id):
+        return self.get(room_id) is not None
+
+    def room_ids(self):
+        raise NotImplementedError
+
+    def lock(self, room_id):
+        raise NotImplementedError
+
+    # ユーザーIDとSocket.IOのSIDの対応
+    def bind_sid(self, user_id, sid):
+        raise NotImplementedError
+
+    def unbind_user(self, user_id):
+        raise NotImplementedError
+
+    def get_sid(self, user_id):
+        raise NotImplementedError
+
+    def get_user_id(self, sid):
+        raise NotImplementedError
+
+    # 全ての (SID, ユーザーID) の組（片付け用）
+    def sid_bindings(self):
+        raise NotImplementedError
+
+    # SIDの対応を削除する（ユーザーの対応は、そのSIDを指している場合だけ削除する）
+    def unbind_sid(self, sid):
+        raise NotImplementedError
+
+
+# ルームごとのロックを管理する
+# ・ロックは取得中・待機中の処理がある間だけ保持し、最後の処理が解放したときに破棄する
+#   （ゲーム状態の削除とは関係なく、保持されているロックが破棄されて同じルームの処理が並行することはない）
+# ・あるルームの処理が他のルームの処理を待たせないようにする
+class RoomLockManager:
+    def __init__(self):
+        self._locks = {}  # ルームID -> [ロック, 取得中・待機中の数]
+        self._guard = Lock()  # _locks 自体の更新を保護する（保持時間はごく短い）
+
+    def get(self, room_id):
+        return _RoomLock(self, room_id)
+
+    def _acquire(self, room_id):
+        with self._guard:
+            entry = self._locks.get(room_id)
+            if entry is None:
+                entry = self._locks[room_id] = [Lock(), 0]
+            entry[1] += 1
+        entry[0].acquire()
+
+    def _release(self, room_id):
+        with self._guard:
+            entry = self._locks[room_id]
+            entry[0].release()
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[room_id]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class _RoomLock:
+    __slots__ = ('manager', 'room_id')
+
+    def __init__(self, manager, room_id):
+        self.manager = manager
+        self.room_id = room_id
+
+    def acquire(self):
+        self.manager._acquire(self.room_id)
+
+    def release(self):
+        self.manager._release(self.room_id)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+# プロセス内の辞書に保持するストア（デフォルト、ワーカー1つの場合）
+class MemoryGameStateStore(GameStateStore):
+    def __init__(self):
+        self.game_states = {}
+        self.user_sid_map = {}
+        self.sid_user_map = {}
+        self.room_locks = RoomLockManager()
+
+    def get(self, room_id):
+        return self.game_states.get(room_id)
+
+    def save(self, room_id, game_state):
+        # 同じオブジェクトを直接書き換えているので代入するだけでよい
+        self.game_states[room_id] = game_state
+
+    def delete(self, room_id):
+        self.game_states.pop(room_id, None)
+
+    def exists(self, room_id):
+        return room_id in self.game_states
+
+    def room_ids(self):
+        return list(self.game_states.keys())
+
+    def lock(self, room_id):
+        return self.room_locks.get(room_id)
+
+    def bind_sid(self, user_id, sid):
+        self.user_sid_map[user_id] = sid
+        self.sid_user_map[sid] = user_id
+
+    def unbind_user(self, user_id):
+        sid = self.user_sid_map.pop(user_id, None)
+        if sid is not None:
+            self.sid_user_map.pop(sid, None)
+        return sid
+
+    def get_sid(self, user_id):
+        return self.user_sid_map.get(user_id)
+
+    def get_user_id(self, sid):
+        return self.sid_user_map.get(sid)
+
+    def sid_bindings(self):
+        return list(self.sid_user_map.items())
+
+    def unbind_sid(self, sid):
+        user_id = self.sid_user_map.pop(sid, None)
+        if user_id is not None and self.user_sid_map.get(user_id) == sid:
+            del self.user_sid_map[user_id]
+
+
+# Redis（互換サーバー）に保持するストア（複数ワーカーで共有する場合）
+class RedisGameStateStore(GameStateStore):
+    def __init__(self, url, prefix='ss:', lock_timeout=10):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('GAME_STATE_BACKEND=redis を使うには redis パッケージが必要です。')
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._lock_timeout = lock_timeout
+
+    def _key(self, room_id):
+        return f"{self._prefix}game:{room_id}"
+
+    def get(self, room_id):
+        raw = self._redis.get(self._key(room_id))
+        if raw is None:
+            return None
+        return GameState.from_dict(json.loads(raw))
+
+    def save(self, room_id, game_state):
+        pipe = self._redis.pipeline()
+        pipe.set(self._key(room_id), json.dumps(game_state.to_dict()))
+        pipe.sadd(f"{self._prefix}rooms", room_id)
+        pipe.execute()
+
+    def delete(self, room_id):
+        pipe = self._redis.pipeline()
+        pipe.delete(self._key(room_id))
+        pipe.srem(f"{self._prefix}rooms", room_id)
+        pipe.execute()
+
+    def exists(self, room_id):
+        return bool(self._redis.exists(self._key(room_id)))
+
+    def room_ids(self):
+        return [int(r) for r in self._redis.smembers(f"{self._prefix}rooms")]
+
+    def lock(self, room_id):
+        # ルームごとの分散ロック（ワーカーをまたいで排他する）
+        return self._redis.lock(f"{self._prefix}lock:{room_id}", timeout=self._lock_timeout)
+
+    def bind_sid(self, user_id, sid):
+        pipe = self._redis.pipeline()
+        pipe.hset(f"{self._prefix}user_sid", user_id, sid)
+        pipe.hset(f"{self._prefix}sid_user", sid, user_id)
+        pipe.execute()
+
+    def unbind_user(self, user_id):
+        sid = self.get_sid(user_id)
+        pipe = self._redis.pipeline()
+        pipe.hdel(f"{self._prefix}user_sid", user_id)
+        if sid is not None:
+            pipe.hdel(f"{self._prefix}sid_user", sid)
+        pipe.execute()
+        return sid
+
+    def get_sid(self, user_id):
+        sid = self._redis.hget(f"{self._prefix}user_sid", user_id)
+        return sid.decode() if sid is not None else None
+
+    def get_user_id(self, sid):
+        user_id = self._redis.hget(f"{self._prefix}sid_user", sid)
+        return int(user_id) if user_id is not None else None
+
+    def sid_bindings(self):
+        return [(sid.decode(), int(user_id)) for sid, user_id in self._redis.hscan_iter(f"{self._prefix}sid_user")]
+
+    def unbind_sid(self, sid):
+        user_id = self.get_user_id(sid)
+        pipe = self._redis.pipeline()
+        pipe.hdel(f"{self._prefix}sid_user", sid)
+        if user_id is not None and self.get_sid(user_id) == sid:
+            pipe.hdel(f"{self._prefix}user_sid", user_id)
+        pipe.execute()
+
+
+def create_game_store(config):
+    backend = config.get('GAME_STATE_BACKEND', 'memory')
+    if backend == 'memory':
+        return MemoryGameStateStore()
+    if backend == 'redis':
+        return RedisGameStateStore(config['REDIS_URL'])
+    raise ValueError(f"不明な GAME_STATE_BACKEND です: {backend}")
@@ -0,0 +1,51 @@
+# identity.py
+
+from collections import namedtuple
+from threading import Lock
+
+
+# Socket.IOの接続（SID）に結び付けたプレイヤー情報
+Identity = namedtuple('Identity', ['user_id', 'name', 'room_id'])
+
+
+# SIDごとのプレイヤー情報のキャッシュ
+# ・join_game で一度だけDBから取得して登録し、以降のイベントではDBを参照しない
+# ・leave_game / disconnect、またはユーザーが別のルームに移ったときに破棄する
+class IdentityCache:
+    def __init__(self):
+        self._by_sid = {}
+        self._sids_by_user = {}
+        self._lock = Lock()
+
+    def bind(self, sid, user_id, name, room_id):
+        identity = Identity(user_id, name, room_id)
+        with self._lock:
+            self._by_sid[sid] = identity
+            self._sids_by_user.setdefault(user_id, set()).add(sid)
+        return identity
+
+    def get(self, sid):
+        return self._by_sid.get(sid)
+
+    def pop(self, sid):
+        with self._lock:
+            identity = self._by_sid.pop(sid, None)
+            if identity is not None:
+                sids = self._sids_by_user.get(identity.user_id)
+                if sids is not None:
+                    sids.discard(sid)
+                    if not sids:
+                        del self._sids_by_user[identity.user_id]
+        return identity
+
+    # ユーザーの全SIDのキャッシュを破棄する（HTTP経由でルームを移動した場合など）
+    def discard_user(self, user_id):
+        with self._lock:
+            for sid in self._sids_by_user.pop(user_id, ()):
+                self._by_sid.pop(sid, None)
+
+    def sids(self):
+        return list(self._by_sid)
+
+    def __len__(self):
+        return len(self._by_sid)
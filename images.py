@@ -0,0 +1,229 @@
+# images.py
+
+import hashlib
+import json
+import math
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow がない場合は縮小版を作らず、元画像をそのまま使う
+    Image = None
+
+log = logging.getLogger('ss.images')
+
+
+# eventlet のモンキーパッチ下ではスレッドがグリーンスレッドになるため、
+# 画像の縮小のような重い処理は本物のスレッド（tpool）で実行してイベントループを止めない
+def _run_blocking(func, *args):
+    try:
+        from eventlet import patcher, tpool
+        if patcher.is_monkey_patched('thread'):
+            return tpool.execute(func, *args)
+    except ImportError:
+        pass
+    return func(*args)
+
+
+# アップロードされたカード画像の保存と縮小版の作成
+# ・画像は内容のハッシュ（SHA-256）をファイル名にして保存し、同じ画像は1つだけ保存する
+# ・カードの大きさに縮小した版（対応していれば WebP）をワーカースレッドで作成する
+# ・デッキの画像を1枚にまとめたスプライトシートと座標のマニフェストを作成する
+class ImagePipeline:
+    def __init__(self, upload_folder, card_size=(320, 320), max_workers=2, on_variant_ready=None,
+                 sprite_max_images=64):
+        self.upload_folder = upload_folder
+        self.card_size = card_size
+        self.on_variant_ready = on_variant_ready  # on_variant_ready(digest, variant_filename)
+        self.sprite_max_images = sprite_max_images  # これより画像の多いデッキはスプライトにしない
+        self.sprite_folder = os.path.join(upload_folder, 'sprites')
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image')
+        self._sprites = {}  # スプライトのキー -> マニフェスト
+        self._building = set()
+        self._sprites_lock = Lock()
+        self._folder_ready = False
+        if Image is None:
+            self.variant_format = None
+        elif features.check('webp'):
+            self.variant_format = ('WEBP', 'webp')
+        else:
+            self.variant_format = ('PNG', 'png')
+
+    # アップロードされたファイルの内容のハッシュ（保存はしない。読み終えたら先頭に戻す）
+    def hash_upload(self, file_storage):
+        sha256 = hashlib.sha256()
+        while True:
+            chunk = file_storage.stream.read(64 * 1024)
+            if not chunk:
+                break
+            sha256.update(chunk)
+        file_storage.stream.seek(0)
+        return sha256.hexdigest()
+
+    # アップロードされたファイルを内容のハッシュ名で保存し、(ハッシュ, ファイル名) を返す
+    def save_upload(self, file_storage, ext):
+        if not self._folder_ready:  # アップロード先は最初の保存時に作成する
+            os.makedirs(self.upload_folder, exist_ok=True)
+            self._folder_ready = True
+        tmp_path = os.path.join(self.upload_folder, f".upload-{uuid.uuid4().hex}")
+        sha256 = hashlib.sha256()
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = file_storage.stream.read(64 * 1024)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                f.write(chunk)
+        digest = sha256.hexdigest()
+        filename = f"{digest}.{ext}"
+        path = os.path.join(self.upload_folder, filename)
+        if os.path.exists(path):
+            os.remove(tmp_path)  # 同じ画像が既に保存されている
+        else:
+            os.replace(tmp_path, path)
+        return digest, filename
+
+    def variant_filename(self, digest):
+        return f"{digest}_card.{self.variant_format[1]}"
+
+    # 縮小版の作成をワーカーに依頼する
+    def submit(self, digest, filename):
+        if self.variant_format is None:
+            return None
+        return self._executor.submit(self._make_variant, digest, filename)
+
+    def _make_variant(self, digest, filename):
+        try:
+            variant = self.variant_filename(digest)
+            variant_path = os.path.join(self.upload_folder, variant)
+            if not os.path.exists(variant_path):
+                _run_blocking(self._resize, os.path.join(self.upload_folder, filename), variant_path)
+            if self.on_variant_ready:
+                self.on_variant_ready(digest, variant)
+            return variant
+        except Exception:
+            log.exception('縮小版の作成に失敗しました: %s', filename)
+            return None
+
+    def _resize(self, src_path, dst_path):
+        with Image.open(src_path) as im:
+            im = ImageOps.exif_transpose(im)
+            im = im.convert('RGBA' if im.mode in ('RGBA', 'LA', 'P') else 'RGB')
+            im.thumbnail(self.card_size)
+            tmp_path = f"{dst_path}.tmp"
+            im.save(tmp_path, format=self.variant_format[0], quality=80)
+            os.replace(tmp_path, dst_path)
+
+    # デッキの画像（ファイル名はハッシュ入り）からスプライトのキーを決める
+    def sprite_key(self, filenames):
+        return hashlib.sha256('\n'.join(sorted(set(filenames))).encode()).hexdigest()[:32]
+
+    # 作成済みのスプライトのマニフェストを返す。まだなければ作成を依頼して None を返す
+    def get_sprite(self, filenames):
+        if self.variant_format is None:
+            return None
+        filenames = sorted(set(filenames))
+        if len(filenames) > self.sprite_max_images:
+            return None
+        key = self.sprite_key(filenames)
+        manifest = self._sprites.get(key)
+        if manifest is not None:
+            return manifest
+        manifest_path = os.path.join(self.sprite_folder, f"{key}.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            with self._sprites_lock:
+                self._sprites[key] = manifest
+            return manifest
+        with self._sprites_lock:
+            if key in self._building:
+                return None
+            self._building.add(key)
+        self._executor.submit(self._make_sprite, key, filenames)
+        return None
+
+    # 画像を同じ大きさのマスに並べて1枚のシートにする
+    # マニフェスト: {'sheet': シートのファイル名, 'cols': 列数, 'rows': 行数, 'cells': {ファイル名: [列, 行]}}
+    def _make_sprite(self, key, filenames):
+        try:
+            os.makedirs(self.sprite_folder, exist_ok=True)
+            manifest = _run_blocking(self._compose_sprite, key, filenames)
+            with open(os.path.join(self.sprite_folder, f"{key}.json.tmp"), 'w') as f:
+                json.dump(manifest, f)
+            os.replace(os.path.join(self.sprite_folder, f"{key}.json.tmp"),
+                       os.path.join(self.sprite_folder, f"{key}.json"))
+            with self._sprites_lock:
+                self._sprites[key] = manifest
+        except Exception:
+            log.exception('スプライトシートの作成に失敗しました: %s', key)
+        finally:
+            with self._sprites_lock:
+                self._building.discard(key)
+
+    def _compose_sprite(self, key, filenames):
+        cols = math.ceil(math.sqrt(len(filenames)))
+        rows = math.ceil(len(filenames) / cols)
+        cell_w, cell_h = self.card_size
+        sheet = Image.new('RGBA', (cols * cell_w, rows * cell_h), (0, 0, 0, 0))
+        cells = {}
+        for i, filename in enumerate(filenames):
+            col, row = i % cols, i // cols
+            with Image.open(os.path.join(self.upload_folder, filename)) as im:
+                im = ImageOps.exif_transpose(im).convert('RGBA')
+                im.thumbnail(self.card_size)
+                # マスの中央に配置する
+                sheet.paste(im, (col * cell_w + (cell_w - im.width) // 2, row * cell_h + (cell_h - im.height) // 2))
+            cells[filename] = [col, row]
+        # シートの内容のハッシュをファイル名にする（URLが変わらない限り内容も変わらない）
+        tmp_path = os.path.join(self.sprite_folder, f"{key}.{self.variant_format[1]}.tmp")
+        sheet.save(tmp_path, format=self.variant_format[0], quality=80)
+        with open(tmp_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        sheet_filename = f"sprites/{digest}.{self.variant_format[1]}"
+        os.replace(tmp_path, os.path.join(self.upload_folder, sheet_filename))
+        return {'sheet': sheet_filename, 'cols': cols, 'rows': rows, 'cells': cells}
+
+    def has_file(self, filename):
+        return os.path.exists(os.path.join(self.upload_folder, filename))
+
+    # 画像ファイルを削除する（既にないものは無視する）
+    def remove_files(self, *filenames):
+        for filename in filenames:
+            if filename:
+                try:
+                    os.remove(os.path.join(self.upload_folder, filename))
+                except FileNotFoundError:
+                    pass
+
+    # 作成済みのスプライトのキーの一覧
+    def sprite_keys(self):
+        try:
+            return [name[:-5] for name in os.listdir(self.sprite_folder) if name.endswith('.json')]
+        except FileNotFoundError:
+            return []
+
+    # 画像が削除されたデッキのスプライトシートとマニフェストを削除し、削除した数を返す
+    def remove_stale_sprites(self, keys):
+        removed = 0
+        for key in keys:
+            manifest_path = os.path.join(self.sprite_folder, f"{key}.json")
+            try:
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if all(os.path.exists(os.path.join(self.upload_folder, filename)) for filename in manifest['cells']):
+                continue
+            with self._sprites_lock:
+                self._sprites.pop(key, None)
+            self.remove_files(f"sprites/{key}.json", manifest['sheet'])
+            removed += 1
+        return removed
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,207 @@
+# journal.py
+
+import atexit
+import importlib
+import json
+import logging
+import os
+
+from game_state import GameState
+
+log = logging.getLogger('ss.journal')
+
+
+# eventlet のモンキーパッチ前の（本物の）モジュールを返す
+def _original(module_name):
+    try:
+        from eventlet import patcher
+        return patcher.original(module_name)
+    except ImportError:
+        return importlib.import_module(module_name)
+
+
+# ゲーム状態の変更を追記するジャーナル（再起動後にゲームを復元する）
+# ・1行1レコードの JSON 配列 [ルームID, 連番, 種類, データ] を追記する
+#   種類は 'snapshot'（ゲーム状態の全体）、'end'（ゲーム終了）、それ以外はルームのイベント名
+# ・追記はキューに入れるだけで、書き込みと fsync は別スレッドでまとめて行う（グループコミット）
+# ・ルームのイベントが snapshot_every 件ごとにスナップショットを書き、復元時の再生を短くする
+# ・起動時に各ルームの最後のスナップショットとその後のイベントから状態を復元し、ファイルを詰め直す
+# ・書き込み用のスレッドは、進行中のルームの最後のスナップショットとその後のレコードを覚えておき、
+#   ファイルが compact_bytes を超え、かつそれらの2倍より大きくなったら、それらだけのファイルに詰め直す
+#   （終了したゲームのレコードはここで消える。書き込みと同じスレッドで行うため追記と競合しない）
+class GameJournal:
+    def __init__(self, path, fsync=True, snapshot_every=100, commit_interval=0.005, max_batch=1024,
+                 compact_bytes=8 * 1024 * 1024):
+        self.path = path
+        self.fsync = fsync
+        self.snapshot_every = snapshot_every
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.compact_bytes = compact_bytes
+        self._queue = _original('queue').SimpleQueue()
+        self._file = None
+        self._thread = None
+        self._snapshot_seq = {}  # ルームID -> 最後のスナップショットの連番
+        # 書き込み用のスレッドだけが使う
+        self._live = {}  # ルームID -> [最後のスナップショットとその後の行, その合計バイト数]
+        self._live_bytes = 0
+        self._file_bytes = 0
+        # メトリクス
+        self.appended = 0
+        self.commits = 0
+        self.compactions = 0
+
+    def start(self):
+        self._ensure_dir()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._file_bytes = self._file.tell()
+        self._thread = _original('threading').Thread(target=self._run, name='journal-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ジャーナルのディレクトリ（instance など）は最初に書き込むときに作成する
+    def _ensure_dir(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+    # ルームのイベントを追記する（ロック内から呼ばれる。キューに入れるだけ）
+    def append(self, room_id, seq, event, data):
+        self._queue.put((room_id, seq, event, data))
+        self.appended += 1
+
+    # ゲーム状態の全体を追記する（呼び出し側で文字列にしておき、以降の変更の影響を受けないようにする）
+    def snapshot(self, room_id, game_state):
+        self._snapshot_seq[room_id] = game_state.seq
+        self._queue.put((room_id, game_state.seq, 'snapshot', self._snapshot_line(room_id, game_state)))
+
+    # 前回のスナップショットから snapshot_every 件以上のイベントがあればスナップショットを書く
+    # （ゲーム状態の変更を書き戻すときに、ロック内から呼ぶ）
+    def maybe_snapshot(self, room_id, game_state):
+        if game_state.seq - self._snapshot_seq.get(room_id, 0) >= self.snapshot_every:
+            self.snapshot(room_id, game_state)
+
+    def end(self, room_id):
+        self._snapshot_seq.pop(room_id, None)
+        self._queue.put((room_id, None, 'end', None))
+
+    def _snapshot_line(self, room_id, game_state):
+        data = game_state.to_dict()
+        data['event_log'] = []  # 直近のイベントはスナップショットの後のレコードから作り直す
+        return json.dumps([room_id, game_state.seq, 'snapshot', data], separators=(',', ':'))
+
+    def _run(self):
+        time = _original('time')
+        while True:
+            batch = [self._queue.get()]
+            # 少し待ってから、その間に溜まったレコードをまとめて書く
+            time.sleep(self.commit_interval)
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Exception:
+                    break
+            stop = None in batch
+            try:
+                self._write(record for record in batch if record is not None)
+            except Exception:
+                log.exception('ジャーナルの書き込みに失敗しました。')
+            if stop:
+                return
+
+    def _write(self, records):
+        lines = []
+        for room_id, seq, kind, data in records:
+            line = (data if kind == 'snapshot' else json.dumps([room_id, seq, kind, data], separators=(',', ':'))) + '\n'
+            lines.append(line)
+            self._track(room_id, kind, line)
+        chunk = ''.join(lines)
+        self._file.write(chunk)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.commits += 1
+        self._file_bytes += len(chunk.encode('utf-8'))
+        if self._file_bytes >= self.compact_bytes and self._file_bytes > 2 * self._live_bytes:
+            self._compact_live()
+
+    # 復元に必要な行（進行中のルームの最後のスナップショットとその後の行）を覚えておく
+    def _track(self, room_id, kind, line):
+        size = len(line.encode('utf-8'))
+        entry = self._live.get(room_id)
+        if kind == 'snapshot' or kind == 'end':
+            if entry is not None:
+                self._live_bytes -= entry[1]
+                del self._live[room_id]
+            if kind == 'snapshot':
+                self._live[room_id] = [[line], size]
+                self._live_bytes += size
+        elif entry is not None:
+            entry[0].append(line)
+            entry[1] += size
+            self._live_bytes += size
+
+    # 覚えている行だけのファイルに置き換えて、追記を続ける（書き込み用のスレッドから呼ぶ）
+    def _compact_live(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for lines, _ in self._live.values():
+                f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._file_bytes = self._file.tell()
+        self.compactions += 1
+        log.info('ジャーナルを詰め直しました（ルーム: %d、%d バイト）', len(self._live), self._file_bytes)
+
+    # 書き込みを終えてファイルを閉じる
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+
+    # ジャーナルからルームごとのゲーム状態を復元する（{ルームID: GameState}）
+    # 書き込み途中で終了した最後の行などの壊れた行は読み飛ばす
+    def recover(self, event_log_size=64):
+        rooms = {}  # ルームID -> (スナップショット, その後のイベント)
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    room_id, seq, kind, data = json.loads(line)
+                except ValueError:
+                    continue
+                if kind == 'snapshot':
+                    rooms[room_id] = (data, [])
+                elif kind == 'end':
+                    rooms.pop(room_id, None)
+                elif room_id in rooms:
+                    rooms[room_id][1].append((seq, kind, data))
+
+        states = {}
+        for room_id, (snapshot, events) in rooms.items():
+            snapshot['event_log_size'] = event_log_size
+            game_state = GameState.from_dict(snapshot)
+            for seq, event, data in events:
+                if seq > game_state.seq:
+                    game_state.apply_event(seq, event, data)
+            states[room_id] = game_state
+        return states
+
+    # 現在のゲーム状態のスナップショットだけを書いたファイルに置き換える（起動時、start() の前に呼ぶ）
+    def compact(self, game_states):
+        self._ensure_dir()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for room_id, game_state in game_states.items():
+                line = self._snapshot_line(room_id, game_state) + '\n'
+                f.write(line)
+                self._snapshot_seq[room_id] = game_state.seq
+                self._track(room_id, 'snapshot', line)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,145 @@
+# leaderboard.py
+
+import bisect
+import time
+from collections import deque
+from threading import Lock
+
+
+# 'day=86400,week=604800' の形式の期間の指定を {期間名: 秒数} にする
+def parse_windows(value):
+    windows = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        name, _, seconds = item.partition('=')
+        windows[name.strip()] = float(seconds)
+    return windows
+
+
+# スコアの高い順に並べたユーザーの一覧（キーは (-合計, ユーザーID)）
+class _Ranking:
+    __slots__ = ('totals', 'keys')
+
+    def __init__(self):
+        self.totals = {}  # ユーザーID -> 合計スコア
+        self.keys = []    # (-合計, ユーザーID) の昇順（＝スコアの高い順）
+
+    def add(self, user_id, score):
+        total = self.totals.get(user_id, 0)
+        if total > 0:
+            del self.keys[bisect.bisect_left(self.keys, (-total, user_id))]
+        total += score
+        if total > 0:
+            self.totals[user_id] = total
+            bisect.insort(self.keys, (-total, user_id))
+        else:
+            self.totals.pop(user_id, None)
+
+    def top(self, limit):
+        return self.keys[:limit]
+
+    # 順位（同点は同じ順位）と合計。一覧にいなければ None
+    def rank(self, user_id):
+        total = self.totals.get(user_id)
+        if total is None:
+            return None
+        return bisect.bisect_left(self.keys, (-total, )) + 1, total
+
+
+# ゲーム結果のランキング（全期間と、直近 N 秒の期間ごと）
+# ・ゲーム終了時に record() で結果を加え、並び順を差分で更新する（結果のテーブルは読まない）
+# ・期間ごとに期間内の結果を古い順に持ち、期間から外れた結果を読み出し・追加のたびに差し引く
+# ・起動時に rebuild() で、全期間はユーザーの合計スコア、期間ごとは最も長い期間内の結果から作り直す
+# ・上位N件の応答はランキングが変わるまで使い回す
+class Leaderboard:
+    def __init__(self, windows=None):
+        self.windows = dict(windows or {})  # 期間名 -> 秒数
+        self._all = _Ranking()
+        self._ranked = {name: _Ranking() for name in self.windows}
+        self._results = {name: deque() for name in self.windows}  # 期間名 -> [(終了時刻, ユーザーID, スコア)]
+        self._names = {}  # ユーザーID -> ユーザー名
+        self._ids = {}    # ユーザー名 -> ユーザーID
+        self._cache = {}  # (期間名, 件数) -> (バージョン, 応答)
+        self.version = 0
+        self._lock = Lock()
+
+    def _ranking(self, window):
+        if window == 'all':
+            return self._all
+        return self._ranked[window]
+
+    def _expire(self, now):
+        changed = False
+        for name, seconds in self.windows.items():
+            results, ranking = self._results[name], self._ranked[name]
+            while results and results[0][0] <= now - seconds:
+                _, user_id, score = results.popleft()
+                ranking.add(user_id, -score)
+                changed = True
+        if changed:
+            self.version += 1
+
+    # totals: [(ユーザーID, ユーザー名, 合計スコア)]、results: [(終了時刻, ユーザーID, ユーザー名, スコア)]（古い順）
+    def rebuild(self, totals, results, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._all = _Ranking()
+            self._ranked = {name: _Ranking() for name in self.windows}
+            self._results = {name: deque() for name in self.windows}
+            self._names, self._ids = {}, {}
+            for user_id, name, total in totals:
+                self._names[user_id], self._ids[name] = name, user_id
+                self._all.add(user_id, total or 0)
+            self._add_results(results, now, update_all=False)
+            self.version += 1
+
+    # ゲームの結果を加える。results: [(終了時刻, ユーザーID, ユーザー名, スコア)]
+    def record(self, results, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._expire(now)
+            self._add_results(results, now, update_all=True)
+            self.version += 1
+
+    def _add_results(self, results, now, update_all):
+        for finished_at, user_id, name, score in results:
+            self._names[user_id], self._ids[name] = name, user_id
+            if update_all:
+                self._all.add(user_id, score)
+            for window, seconds in self.windows.items():
+                if finished_at > now - seconds:
+                    self._results[window].append((finished_at, user_id, score))
+                    self._ranked[window].add(user_id, score)
+
+    # 上位 limit 件。[{'rank', 'username', 'score'}]（window が不明なら KeyError）
+    def top(self, window='all', limit=10, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            ranking = self._ranking(window)
+            self._expire(now)
+            cached = self._cache.get((window, limit))
+            if cached and cached[0] == self.version:
+                return cached[1]
+            entries, rank, previous = [], 0, None
+            for i, (key, user_id) in enumerate(ranking.top(limit)):
+                if key != previous:
+                    rank, previous = i + 1, key
+                entries.append({'rank': rank, 'username': self._names.get(user_id), 'score': -key})
+            self._cache[(window, limit)] = (self.version, entries)
+            return entries
+
+    # ユーザーの順位と合計スコア（{'rank', 'username', 'score'}）。一覧にいなければ None
+    def rank(self, user_id, window='all', now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            ranking = self._ranking(window)
+            self._expire(now)
+            found = ranking.rank(user_id)
+            if found is None:
+                return None
+            return {'rank': found[0], 'username': self._names.get(user_id), 'score': found[1]}
+
+    def user_id(self, name):
+        return self._ids.get(name)
+
+    def __len__(self):
+        return len(self._all.totals)
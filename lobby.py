@@ -0,0 +1,188 @@
+# lobby.py
+
+import hashlib
+import heapq
+import time
+from threading import Lock
+
+
+# ロビー（ルーム一覧）のスナップショット
+# ・ルームID、名前、状態、参加人数を1回の集計クエリで取得してメモリに保持する
+# ・ルームの作成、参加、離脱、ゲーム開始/終了で invalidate() し、次のアクセスで作り直す
+# ・複数ワーカーの場合は他のワーカーでの変更が届かないため、ttl 秒経過しても作り直す
+class LobbyCache:
+    def __init__(self, loader, ttl=5.0):
+        self._loader = loader  # [(id, name, status, player_count), ...] を返す関数
+        self.ttl = ttl
+        self._rooms = None
+        self._etag = None
+        self._built_at = 0.0
+        self._lock = Lock()
+        self._listeners = []
+
+    # invalidate() のたびに呼ばれる関数を登録する
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def invalidate(self):
+        self._rooms = None
+        for listener in self._listeners:
+            listener()
+
+    def _build(self):
+        rooms = [
+            {'id': room_id, 'name': name, 'status': status, 'player_count': player_count}
+            for room_id, name, status, player_count in self._loader()
+        ]
+        digest = hashlib.md5(repr([tuple(r.values()) for r in rooms]).encode()).hexdigest()
+        self._rooms, self._etag, self._built_at = rooms, digest, time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            if self._rooms is None or time.monotonic() - self._built_at > self.ttl:
+                self._build()
+            return self._rooms, self._etag
+
+    # 1ページ分のルームと、ページ数、ETag を返す
+    def page(self, page, per_page):
+        rooms, etag = self.snapshot()
+        num_pages = max(1, -(-len(rooms) // per_page))
+        page = min(max(page, 1), num_pages)
+        start = (page - 1) * per_page
+        return rooms[start:start + per_page], page, num_pages, f"{etag}-{page}"
+
+
+# ロビーの変更を /lobby 名前空間のクライアントに差分で送る
+# ・接続時にスナップショットを1回送り、以降は追加/変更/削除されたルームだけを送る
+# ・invalidate() が続けて呼ばれても、interval 秒ごとに1回だけまとめて送る
+class LobbyBroadcaster:
+    def __init__(self, lobby_cache, emit, schedule):
+        self._cache = lobby_cache
+        self._emit = emit          # emit(イベント名, データ)
+        self._schedule = schedule  # flush() を一定時間後に呼ぶよう予約する関数
+        self._last = None          # 最後に送信した時点のルーム（ID -> ルーム）
+        self._pending = False
+        self._lock = Lock()
+
+    def mark_dirty(self):
+        with self._lock:
+            if self._pending:
+                return
+            self._pending = True
+        self._schedule()
+
+    def snapshot(self):
+        rooms, etag = self._cache.snapshot()
+        if self._last is None:
+            self._last = {room['id']: room for room in rooms}
+        return {'rooms': rooms, 'etag': etag}
+
+    # 前回送信時との差分を計算して送る
+    def flush(self):
+        with self._lock:
+            self._pending = False
+        rooms, _ = self._cache.snapshot()
+        current = {room['id']: room for room in rooms}
+        last = self._last
+        self._last = current
+        if last is None:
+            return
+
+        added = [room for room_id, room in current.items() if room_id not in last]
+        removed = [room_id for room_id in last if room_id not in current]
+        changed = []
+        for room_id, room in current.items():
+            old = last.get(room_id)
+            if old is None or old == room:
+                continue
+            change = {'id': room_id}
+            for field in ('name', 'status', 'player_count'):
+                if room[field] != old[field]:
+                    change[field] = room[field]
+            changed.append(change)
+
+        if added or removed or changed:
+            self._emit('lobby_diff', {'added': added, 'changed': changed, 'removed': removed})
+
+
+# クイック参加用の、参加できる待機中のルームの索引
+# ・ルームごとの状態と参加人数をメモリに持ち、ルームの作成・参加・離脱・ゲーム開始/終了のたびに差分で更新する
+# ・参加できるルーム（待機中、1人以上、満員でない）を、空き席の少ない順、古い（IDの小さい）順のヒープに入れる
+#   変更のたびに新しい項目を追加し、古くなった項目は取り出すときに読み飛ばす（O(log n)）
+# ・ワーカーごとの索引なので、他のワーカーでの変更は参加時にDBで確認する
+class OpenRoomIndex:
+    def __init__(self, max_players):
+        self.max_players = max_players
+        self._rooms = {}  # ルームID -> [状態, 参加人数]
+        self._heap = []   # (-参加人数, ルームID)
+        self._lock = Lock()
+
+    def _is_open(self, room):
+        return room[0] == 'waiting' and 0 < room[1] < self.max_players
+
+    def _push(self, room_id, room):
+        if self._is_open(room):
+            heapq.heappush(self._heap, (-room[1], room_id))
+            # 古くなった項目が増えたら作り直す
+            if len(self._heap) > 2 * len(self._rooms) + 64:
+                self._heap = [(-r[1], rid) for rid, r in self._rooms.items() if self._is_open(r)]
+                heapq.heapify(self._heap)
+
+    # 起動時などに、DBの内容で作り直す（rooms: [(ID, 状態, 参加人数)]）
+    def rebuild(self, rooms):
+        with self._lock:
+            self._rooms = {room_id: [status, players] for room_id, status, players in rooms}
+            self._heap = [(-r[1], room_id) for room_id, r in self._rooms.items() if self._is_open(r)]
+            heapq.heapify(self._heap)
+
+    def set_room(self, room_id, status, players):
+        with self._lock:
+            room = self._rooms[room_id] = [status, players]
+            self._push(room_id, room)
+
+    def set_status(self, room_id, status):
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is not None and room[0] != status:
+                room[0] = status
+                self._push(room_id, room)
+
+    # ユーザーがルームを移動した（old_room_id、new_room_id は None でもよい）
+    def move(self, old_room_id, new_room_id):
+        with self._lock:
+            for room_id, delta in ((old_room_id, -1), (new_room_id, 1)):
+                room = self._rooms.get(room_id)
+                if room is not None:
+                    room[1] = max(0, room[1] + delta)
+                    self._push(room_id, room)
+
+    def remove(self, room_id):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+
+    # 最も空き席の少ないルームを選び、1席予約してルームIDを返す（なければ None）
+    def reserve(self, exclude=None):
+        with self._lock:
+            skipped = []
+            room_id = None
+            while self._heap:
+                neg_players, candidate = self._heap[0]
+                room = self._rooms.get(candidate)
+                if room is None or not self._is_open(room) or room[1] != -neg_players:
+                    heapq.heappop(self._heap)  # 古くなった項目
+                    continue
+                if candidate == exclude:
+                    skipped.append(heapq.heappop(self._heap))
+                    continue
+                room_id = candidate
+                heapq.heappop(self._heap)
+                room[1] += 1
+                self._push(room_id, room)
+                break
+            for entry in skipped:
+                heapq.heappush(self._heap, entry)
+            return room_id
+
+    def __len__(self):
+        with self._lock:
+            return sum(1 for room in self._rooms.values() if self._is_open(room))
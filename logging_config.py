@@ -0,0 +1,116 @@
+# logging_config.py
+
+import importlib
+import json
+import logging
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+
+# ログに付ける構造化フィールド（extra で渡す）
+FIELDS = ('event', 'room_id', 'user_id', 'sid')
+
+
+# eventlet のモンキーパッチ前の（本物の）モジュールを返す
+def _original(module_name):
+    try:
+        from eventlet import patcher
+        return patcher.original(module_name)
+    except ImportError:
+        return importlib.import_module(module_name)
+
+
+# ログの書き出しを本物のスレッドで行う QueueListener
+# （eventlet のモンキーパッチ下でも標準出力への書き込みがイベントループを止めない）
+class ThreadQueueListener(QueueListener):
+    def start(self):
+        self._thread = _original('threading').Thread(target=self._monitor, name='log-writer', daemon=True)
+        self._thread.start()
+
+
+# key=value 形式のフォーマッタ
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record):
+        fields = ' '.join(f"{name}={getattr(record, name)}" for name in FIELDS if getattr(record, name, None) is not None)
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}"
+        if fields:
+            line += f" {fields}"
+        line += f" {record.getMessage()}"
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+# 1行1JSONのフォーマッタ（ログ収集基盤向け）
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+# イベントごとのサンプリング
+# ・rates は {イベント名: N} で、そのイベントの WARNING 未満のログを N 件に1件だけ出力する
+class EventSamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._counts = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        n = self.rates.get(getattr(record, 'event', None))
+        if not n or n <= 1:
+            return True
+        with self._lock:
+            count = self._counts.get(record.event, 0)
+            self._counts[record.event] = count + 1
+        return count % n == 0
+
+
+# 'flip_card=10,join_game=2' の形式を {イベント名: N} にする
+def parse_sampling(value):
+    rates = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        event, _, n = item.partition('=')
+        rates[event.strip()] = int(n)
+    return rates
+
+
+_listener = None
+
+
+# 'ss' ロガー以下の設定
+# ・ログはキューに入れるだけで、書き出しは別スレッドで行う
+# ・デフォルトのレベルは INFO（DEBUG のログは LOG_LEVEL=DEBUG で出力する）
+def configure_logging(level='INFO', fmt='text', sampling=None):
+    global _listener
+    logger = logging.getLogger('ss')
+    logger.setLevel(level)
+    logger.propagate = False
+    if _listener is not None:
+        _listener.stop()
+        logger.handlers.clear()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if fmt == 'json' else KeyValueFormatter())
+    log_queue = _original('queue').SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(EventSamplingFilter(sampling or {}))
+    logger.addHandler(queue_handler)
+
+    _listener = ThreadQueueListener(log_queue, stream_handler)
+    _listener.start()
+    return logger
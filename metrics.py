@@ -0,0 +1,202 @@
+# metrics.py
+
+import time
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+
+from flask import g, request
+
+# 処理時間のヒストグラムのバケット（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# ラベルごとの値を持つヒストグラム（Prometheus の histogram と同じ形式で出力する）
+class Histogram:
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}  # ラベルの値 -> [バケットごとの件数, 合計, 件数]
+        self._lock = Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    # ブロック（with）の処理時間を記録する
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        for label_values, counts, total, count in sorted(values):
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'label_values', 'start')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+# 出力のたびに関数を呼んで値を取得するメトリクス（ゲージ・カウンタ）
+# func は値、または {ラベルの値のタプル: 値} を返す
+class Collected:
+    def __init__(self, name, help, func, type='gauge', label_names=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+        self.label_names = tuple(label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        value = self.func()
+        if isinstance(value, dict):
+            for label_values, v in sorted(value.items()):
+                lines.append(f"{self.name}{_format_labels(list(zip(self.label_names, label_values)))} {_format_value(v)}")
+        else:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+# ルームのロックの待ち時間と保持時間を記録するラッパー
+# （threading.Lock、redis のロックのどちらにも使える）
+class TimedLock:
+    __slots__ = ('lock', 'metrics', 'acquired_at')
+
+    def __init__(self, lock, metrics):
+        self.lock = lock
+        self.metrics = metrics
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        self.metrics.observe_lock_wait(self.acquired_at - start)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.lock.release()
+        self.metrics.lock_hold.observe(time.perf_counter() - self.acquired_at)
+
+
+# アプリケーションのメトリクス
+# ・Flask のルートは init_app() で全て、Socket.IO のハンドラとスケジューラの処理はデコレータで処理時間を記録する
+# ・render() で Prometheus のテキスト形式にする
+class Metrics:
+    def __init__(self, prefix='ss_'):
+        self.prefix = prefix
+        self.http = Histogram(prefix + 'http_request_duration_seconds', 'Flask ルートの処理時間', ['endpoint'])
+        self.socketio = Histogram(prefix + 'socketio_event_duration_seconds', 'Socket.IO イベントの処理時間', ['event'])
+        self.tasks = Histogram(prefix + 'task_duration_seconds', 'スケジューラから呼ばれる処理の時間', ['task'])
+        self.lock_wait = Histogram(prefix + 'room_lock_wait_seconds', 'ルームのロックの待ち時間')
+        self.lock_hold = Histogram(prefix + 'room_lock_hold_seconds', 'ルームのロックの保持時間')
+        self._metrics = [self.http, self.socketio, self.tasks, self.lock_wait, self.lock_hold]
+        # 過負荷の判定用（処理中の Socket.IO イベント数、ロックの待ち時間の移動平均）
+        self.events_in_flight = 0
+        self._lock_wait_avg = 0.0
+        self._lock_wait_at = time.monotonic()
+
+    # 全てのルートの処理時間を記録する（他の before_request より先に登録する）
+    def init_app(self, app):
+        @app.before_request
+        def start_request_timer():
+            g.request_started_at = time.perf_counter()
+
+        @app.teardown_request
+        def observe_request(exc):
+            started_at = g.pop('request_started_at', None)
+            if started_at is not None:
+                self.http.observe(time.perf_counter() - started_at, request.endpoint or 'not_found')
+
+    def track_event(self, event_name):
+        timed = self._timed(self.socketio, event_name)
+
+        def decorator(f):
+            f = timed(f)
+
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                self.events_in_flight += 1
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.events_in_flight -= 1
+            return wrapper
+        return decorator
+
+    def track_task(self, task_name):
+        return self._timed(self.tasks, task_name)
+
+    def _timed(self, histogram, label):
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with histogram.time(label):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def timed_lock(self, lock):
+        return TimedLock(lock, self)
+
+    def observe_lock_wait(self, seconds):
+        self.lock_wait.observe(seconds)
+        self._lock_wait_avg = self.lock_wait_avg + (seconds - self.lock_wait_avg) * 0.1
+        self._lock_wait_at = time.monotonic()
+
+    # 直近の待ち時間ほど重くした移動平均（厳密さは不要なのでロックは取らない）
+    # ロックを取る処理がなければ1秒ごとに半分に減らす（断っている間に元に戻れるようにする）
+    @property
+    def lock_wait_avg(self):
+        return self._lock_wait_avg * 0.5 ** (time.monotonic() - self._lock_wait_at)
+
+    def gauge(self, name, help, func, label_names=()):
+        self._metrics.append(Collected(self.prefix + name, help, func, 'gauge', label_names))
+
+    def counter(self, name, help, func, label_names=()):
+        self._metrics.append(Collected(self.prefix + name, help, func, 'counter', label_names))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,61 @@
+# outbound.py
+
+# 短いキーの形式（SOCKETIO_COMPACT=1）で使う、イベント名とフィールド名の短縮形
+# クライアントには同じ表を渡して元の名前に戻させる
+COMPACT_EVENTS = {
+    'card_flipped': 'f',
+    'match_result': 'm',
+    'cards_reset': 'r',
+    'turn_changed': 't',
+}
+COMPACT_KEYS = {
+    'card_id': 'c',
+    'position': 'p',
+    'username': 'u',
+    'card1_id': 'a',
+    'card2_id': 'b',
+    'matched': 'k',
+    'scores': 'sc',
+    'current_turn': 't',
+    'seq': 's',
+}
+
+
+def compact_event(event, data):
+    return [COMPACT_EVENTS.get(event, event), {COMPACT_KEYS.get(key, key): value for key, value in data.items()}]
+
+
+# ルームごとの送信バッファ
+# ・1回の処理（ルームのロック内）で発生したゲームのイベントを溜めておき、flush() で1つのフレームにまとめて送る
+#   例: 2枚目の card_flipped と match_result、cards_reset と turn_changed
+# ・イベントが1つだけの場合は通常どおりイベント名で送り、複数の場合は 'game_events'（再接続時と同じ形式）で送る
+# ・compact=True の場合は常に 'ge' で、イベント名とキーを短縮した [短縮名, データ] の配列を送る
+class RoomOutbox:
+    def __init__(self, emit, compact=False):
+        self.emit = emit  # emit(event, data, room_id)
+        self.compact = compact
+        self._pending = {}  # ルームID -> [(イベント名, データ)]
+        # メトリクス
+        self.events = 0
+        self.frames = 0
+
+    # ルームのロック内から呼ぶ
+    def add(self, room_id, event, data):
+        self._pending.setdefault(room_id, []).append((event, data))
+
+    # 溜めたイベントを送る（add() と同じロック内から呼ぶ）
+    def flush(self, room_id):
+        events = self._pending.pop(room_id, None)
+        if not events:
+            return
+        self.events += len(events)
+        self.frames += 1
+        if self.compact:
+            self.emit('ge', [compact_event(event, data) for event, data in events], room_id)
+        elif len(events) == 1:
+            self.emit(events[0][0], events[0][1], room_id)
+        else:
+            self.emit('game_events', {
+                'events': [{'event': event, 'data': data} for event, data in events],
+                'seq': events[-1][1]['seq'],
+            }, room_id)
@@ -0,0 +1,50 @@
+# query_counter.py
+
+from functools import wraps
+from threading import Lock
+
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Socket.IOのイベントごとのDBクエリ数を数える
+# ・SQLAlchemyの before_cursor_execute で、実行中のイベントのカウンタ（flask.g）を増やす
+# ・track() を付けたハンドラごとに、イベント数とクエリ数の合計を集計する
+class QueryCounter:
+    def __init__(self):
+        self.totals = {}  # イベント名 -> [イベント数, クエリ数]
+        self._lock = Lock()
+
+    def install(self):
+        event.listen(Engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_app_context() and 'db_queries' in g:
+            g.db_queries += 1
+
+    def track(self, event_name):
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                g.db_queries = 0
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    with self._lock:
+                        totals = self.totals.setdefault(event_name, [0, 0])
+                        totals[0] += 1
+                        totals[1] += g.db_queries
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                event_name: {
+                    'events': events,
+                    'queries': queries,
+                    'queries_per_event': queries / events if events else 0.0,
+                }
+                for event_name, (events, queries) in self.totals.items()
+            }
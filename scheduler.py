@@ -0,0 +1,136 @@
+# scheduler.py
+
+import heapq
+import itertools
+import logging
+import math
+import time
+from threading import Lock
+
+log = logging.getLogger('ss.scheduler')
+
+
+class Timer:
+    __slots__ = ('due', 'key', 'func', 'args', 'background', 'cancelled')
+
+    def __init__(self, due, key, func, args, background=False):
+        self.due = due
+        self.key = key
+        self.func = func
+        self.args = args
+        self.background = background
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+# ルームの遅延処理（カードを裏返す、ゲーム終了など）をまとめて実行するスケジューラ
+# ・タイマーごとにバックグラウンドタスクを作らず、1つのループがヒープから期限の来たものを実行する
+# ・タイマーはキー（ルームID）ごとにまとめてキャンセルできる
+# ・予定時刻からの遅れ（ラグ）を記録する
+# ・ループで直接実行するのは軽い処理（カードを裏返すなど）だけにする。DBの読み書きなどの重い処理は
+#   background=True で予約し、期限が来たらバックグラウンドタスクで実行する（他のルームのタイマーを遅らせない）
+class RoomScheduler:
+    def __init__(self, tick=0.05):
+        self.tick = tick
+        self._heap = []
+        self._by_key = {}
+        self._seq = itertools.count()
+        self._lock = Lock()
+        self._started = False
+        self._start_background_task = None
+        self._sleep = time.sleep
+        # メトリクス
+        self.fired = 0
+        self.started_tasks = 0  # バックグラウンドタスクで実行した数
+        self.cancelled = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+
+    # socketio.start_background_task / socketio.sleep を渡してループを動かす
+    def init_app(self, start_background_task, sleep):
+        self._start_background_task = start_background_task
+        self._sleep = sleep
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._start_background_task(self._run)
+
+    # delay が nan・inf のタイマーはヒープの先頭に残り続け、後のタイマーが全て実行されなくなるためエラーにする
+    def schedule(self, delay, key, func, *args, background=False):
+        if not math.isfinite(delay):
+            raise ValueError(f"タイマーの遅延が有限の値ではありません: {delay!r}")
+        timer = Timer(time.monotonic() + delay, key, func, args, background)
+        with self._lock:
+            heapq.heappush(self._heap, (timer.due, next(self._seq), timer))
+            self._by_key.setdefault(key, set()).add(timer)
+        self._ensure_started()
+        return timer
+
+    # キーに紐づく未実行のタイマーを全てキャンセルする
+    def cancel(self, key):
+        with self._lock:
+            timers = self._by_key.pop(key, ())
+            for timer in timers:
+                timer.cancel()
+            self.cancelled += len(timers)
+        return len(timers)
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, timer = heapq.heappop(self._heap)
+                if timer.cancelled:
+                    continue
+                timers = self._by_key.get(timer.key)
+                if timers is not None:
+                    timers.discard(timer)
+                    if not timers:
+                        del self._by_key[timer.key]
+                due.append(timer)
+        return due
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            for timer in self._pop_due(now):
+                lag = time.monotonic() - timer.due
+                self.lag_last = lag
+                self.lag_max = max(self.lag_max, lag)
+                self.lag_total += lag
+                self.fired += 1
+                if timer.background:
+                    self.started_tasks += 1
+                    self._start_background_task(self._fire, timer)
+                else:
+                    self._fire(timer)
+            self._sleep(self.tick)
+
+    def _fire(self, timer):
+        try:
+            timer.func(*timer.args)
+        except Exception:
+            log.exception('タイマーの処理でエラーが発生しました: %s', getattr(timer.func, '__name__', timer.func), extra={'room_id': timer.key})
+
+    def pending(self):
+        with self._lock:
+            return sum(len(timers) for timers in self._by_key.values())
+
+    def stats(self):
+        return {
+            'pending': self.pending(),
+            'fired': self.fired,
+            'background_tasks': self.started_tasks,
+            'cancelled': self.cancelled,
+            'lag_last': self.lag_last,
+            'lag_max': self.lag_max,
+            'lag_avg': self.lag_total / self.fired if self.fired else 0.0,
+        }
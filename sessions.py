@@ -0,0 +1,152 @@
+# sessions.py
+
+import secrets
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+# サーバー側にセッションを保持する SessionInterface の共通部分
+# ・クッキーにはランダムなセッションIDだけを入れる
+# ・内容が変更されていないリクエストでは保存もクッキーの再設定も行わない
+# ・空のセッションは保存しない（フラッシュメッセージを表示し終えたら削除する）
+class ServerSideSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def _load(self, sid):
+        raise NotImplementedError
+
+    def _store(self, sid, data):
+        raise NotImplementedError
+
+    def _delete(self, sid):
+        raise NotImplementedError
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self._load(sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        if not session.modified:
+            return
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if not session.new:
+                self._delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        self._store(session.sid, dict(session))
+        if session.new:
+            response.set_cookie(
+                name,
+                session.sid,
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+# プロセス内のメモリに保持するセッション（デフォルト、ワーカー1つの場合）
+# ・最後のアクセスから ttl 秒で期限切れになる
+# ・max_entries を超えたら、最も長くアクセスされていないものから削除する（LRU）
+class MemorySessionInterface(ServerSideSessionInterface):
+    def __init__(self, ttl=3600, max_entries=10000):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()  # セッションID -> (データ, 期限)、古い順
+        self._lock = Lock()
+        self.evicted = 0
+        self.expired = 0
+
+    def _purge_expired(self, now):
+        # アクセスのたびに末尾へ移動するので、先頭から期限切れのものを削除すればよい
+        while self._sessions:
+            sid, (_, expires_at) = next(iter(self._sessions.items()))
+            if expires_at > now:
+                break
+            del self._sessions[sid]
+            self.expired += 1
+
+    def _load(self, sid):
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            self._sessions[sid] = (entry[0], now + self.ttl)
+            self._sessions.move_to_end(sid)
+            return dict(entry[0])
+
+    def _store(self, sid, data):
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[sid] = (data, now + self.ttl)
+            self._sessions.move_to_end(sid)
+            self._purge_expired(now)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+
+    def _delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+# Redis（互換サーバー）に保持するセッション（複数ワーカーで共有する場合）
+class RedisSessionInterface(ServerSideSessionInterface):
+    def __init__(self, url, ttl=3600, prefix='ss:session:'):
+        super().__init__(ttl)
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('SESSION_BACKEND=redis を使うには redis パッケージが必要です。')
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def _load(self, sid):
+        raw = self._redis.get(self._prefix + sid)
+        return self.serializer.loads(raw.decode()) if raw is not None else None
+
+    def _store(self, sid, data):
+        self._redis.setex(self._prefix + sid, self.ttl, self.serializer.dumps(data))
+
+    def _delete(self, sid):
+        self._redis.delete(self._prefix + sid)
+
+
+def create_session_interface(config):
+    backend = config.get('SESSION_BACKEND', 'memory')
+    if backend == 'memory':
+        return MemorySessionInterface(ttl=config['SESSION_TTL'], max_entries=config['SESSION_MAX_ENTRIES'])
+    if backend == 'redis':
+        return RedisSessionInterface(config['REDIS_URL'], ttl=config['SESSION_TTL'])
+    raise ValueError(f"不明な SESSION_BACKEND です: {backend}")
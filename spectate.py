@@ -0,0 +1,145 @@
+# spectate.py
+
+from threading import Lock
+
+
+# 現在のターンのプレイヤー名（current_turn はユーザーID（開始直後）またはユーザー名）
+def current_turn_name(game_state):
+    current_turn = game_state.current_turn
+    if not isinstance(current_turn, str):
+        current_turn = game_state.player_names.get(current_turn, current_turn)
+    return current_turn
+
+
+# カードの表の面（カード名と画像のファイル名）
+def card_face(game_state, index):
+    pair_id = game_state.pair_ids[index]
+    return {'name': game_state.pair_names[pair_id], 'image': game_state.pair_images[pair_id]}
+
+
+# 観戦用のスナップショット（表の面は、めくられているカードとマッチしたカードの分だけ含める）
+def spectator_snapshot(game_state):
+    cards = {}
+    for i, card_id in enumerate(game_state.card_ids):
+        card = {
+            'is_flipped': bool(game_state.flipped[i]),
+            'is_matched': bool(game_state.matched[i]),
+            'position': i + 1,
+        }
+        if card['is_flipped'] or card['is_matched']:
+            card.update(card_face(game_state, i))
+        cards[str(card_id)] = card
+    return {
+        'cards': cards,
+        'current_turn': current_turn_name(game_state),
+        'players': [game_state.player_names.get(user_id) for user_id in game_state.players],
+        'scores': game_state.scores_payload(),
+        'flipped_cards': list(game_state.flipped_cards),
+        'seq': game_state.seq,
+    }
+
+
+# 観戦者に送るイベント（めくられたカードには表の面を付ける）
+def spectator_event(game_state, event, data):
+    if event == 'card_flipped':
+        index = game_state.index_of(int(data['card_id']))
+        if index is not None:
+            data = dict(data, **card_face(game_state, index))
+    return {'event': event, 'data': data}
+
+
+# ルームごとの観戦用の配信
+# ・観戦者には共有のゲーム状態（ストア）の連番とイベントの記録から送る。どのワーカーでゲームが進んでも、
+#   どのワーカーに接続している観戦者にも届く（複数ワーカーでは Socket.IO のメッセージキューを経由する）
+# ・プレイヤーの処理（ルームのロック内）からは送信を予約するだけで、観戦者への送信は interval 秒ごとにまとめて1回、
+#   スケジューラから行う（ゲーム状態を読み、このワーカーが前回送った連番より後のイベントを送る）
+# ・他のワーカーが送ったイベントと重なった分は、クライアントが連番で読み飛ばす
+# ・イベントの記録から溢れて差分を作れない場合は、スナップショットを送り直す
+class SpectatorFeed:
+    def __init__(self, load, emit, schedule, interval=0.1, shared=False):
+        self._load = load          # load(ルームID): 共有のゲーム状態（ゲーム中でなければ None）
+        self._emit = emit          # emit(イベント名, データ, ルームID): ルームの観戦者に送る
+        self._schedule = schedule  # schedule(秒数, ルームID): flush(ルームID) を予約する
+        self.interval = interval
+        self.shared = shared  # 他のワーカーの観戦者にも届く場合は、このワーカーの観戦者数によらず送る
+        self._sent = {}       # ルームID -> このワーカーが観戦者に送った最後の連番
+        self._scheduled = set()
+        self._watching = {}   # SID -> ルームID
+        self._viewers = {}    # ルームID -> 観戦者数
+        self._lock = Lock()
+        # メトリクス
+        self.frames = 0
+
+    # ゲーム開始時・復元時に呼ぶ（ルームのロック内）
+    def start(self, room_id, game_state):
+        self._sent[room_id] = game_state.seq
+
+    # ルームでイベントが発生したことを伝える（ルームのロック内から呼ばれる。必要なら送信を予約するだけ）
+    def publish(self, room_id, event, data):
+        self._sent.setdefault(room_id, data['seq'] - 1)
+        if room_id in self._scheduled:
+            return
+        if not self.shared and not self._viewers.get(room_id):
+            self._sent[room_id] = data['seq']  # 観戦者がいない間のイベントは送らない
+            return
+        self._scheduled.add(room_id)
+        self._schedule(self.interval, room_id)
+
+    # 前回送った後のイベントを観戦者にまとめて送る
+    def flush(self, room_id):
+        self._scheduled.discard(room_id)
+        game_state = self._load(room_id)
+        if game_state is None:
+            return
+        with self._lock:
+            sent = self._sent.get(room_id, game_state.seq)
+            self._sent[room_id] = game_state.seq
+        if sent >= game_state.seq:
+            return
+        events = game_state.events_since(sent)
+        self.frames += 1
+        if events is None:
+            self._emit('game_state', spectator_snapshot(game_state), room_id)
+        else:
+            self._emit('game_events', {
+                'events': [spectator_event(game_state, e['event'], e['data']) for e in events],
+                'seq': game_state.seq,
+            }, room_id)
+
+    # ゲーム終了時に、ゲーム状態を削除する前に呼ぶ（未送信のイベントを送ってから破棄する）
+    def end(self, room_id):
+        self.flush(room_id)
+        self._sent.pop(room_id, None)
+
+    # 観戦を始める。観戦用のスナップショットを返す（ゲーム中でなければ None）
+    # 観戦者のグループに入ってから呼ぶ（スナップショットの後に他のワーカーが送ったイベントを取りこぼさない）
+    def watch(self, sid, room_id):
+        game_state = self._load(room_id)
+        if game_state is None:
+            return None
+        with self._lock:
+            previous = self._watching.get(sid)
+            if previous != room_id:
+                if previous is not None:
+                    self._remove_viewer(previous)
+                self._watching[sid] = room_id
+                self._viewers[room_id] = self._viewers.get(room_id, 0) + 1
+        return spectator_snapshot(game_state)
+
+    # 観戦をやめる（切断時）。観戦していたルームIDを返す
+    def unwatch(self, sid):
+        with self._lock:
+            room_id = self._watching.pop(sid, None)
+            if room_id is not None:
+                self._remove_viewer(room_id)
+            return room_id
+
+    def _remove_viewer(self, room_id):
+        self._viewers[room_id] -= 1
+        if not self._viewers[room_id]:
+            del self._viewers[room_id]
+
+    def viewers(self, room_id=None):
+        if room_id is None:
+            return len(self._watching)
+        return self._viewers.get(room_id, 0)
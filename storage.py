@@ -0,0 +1,75 @@
+# storage.py
+
+import logging
+
+from sqlalchemy import Column, Index, MetaData, Table, event, inspect, text
+
+log = logging.getLogger('ss.storage')
+
+
+# SQLiteの接続ごとの設定
+# ・WAL: 読み込みが書き込みを待たない（ゲーム中の参照とルーム作成などの書き込みが並行できる）
+# ・synchronous=NORMAL: WALではコミットごとのfsyncを省いても、電源断時以外はデータを失わない
+# ・busy_timeout: 他の接続が書き込み中の場合、すぐにエラーにせず待つ
+def configure_sqlite(engine, busy_timeout_ms=5000):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={busy_timeout_ms}')
+        cursor.close()
+
+
+# スキーマのマイグレーション
+# ・db.create_all() は既存のテーブルを変更しないため、既存のDBへの変更はここに追加する
+# ・適用済みのバージョンは schema_version テーブルに記録し、新しいものだけを順に適用する
+# ・インデックスは (名前, テーブル, 列) で指定し、DDLはSQLAlchemyでDBの方言に合わせて作る
+#   （PostgreSQL では user が予約語のため、テーブル名・列名をそのまま書いたSQLは使えない）
+MIGRATIONS = [
+    # 1: ルームIDでの検索用のインデックス
+    [
+        ('ix_user_room_id', 'user', ('room_id', )),
+        ('ix_card_room_id', 'card', ('room_id', )),
+    ],
+    # 2: ルームのカードを位置の順に（ページ単位で）取得するためのインデックス
+    [
+        ('ix_card_room_id_position', 'card', ('room_id', 'position')),
+    ],
+]
+
+
+# インデックスがなければ作成する（識別子のクォートはSQLAlchemyに任せる）
+def _create_index(conn, name, table_name, columns):
+    table = Table(table_name, MetaData(), *(Column(column) for column in columns))
+    Index(name, *(table.c[column] for column in columns)).create(conn, checkfirst=True)
+
+
+def migrate(engine):
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+        version = conn.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+        for number, indexes in enumerate(MIGRATIONS[version:], start=version + 1):
+            for name, table_name, columns in indexes:
+                _create_index(conn, name, table_name, columns)
+            conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': number})
+            log.info('マイグレーション %d を適用しました。', number)
+
+
+# 適用済みのマイグレーションのバージョン（スキーマが作成されていなければ None）
+def schema_version(engine):
+    with engine.connect() as conn:
+        if not inspect(conn).has_table('schema_version'):
+            return None
+        return conn.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+
+# スキーマが最新でなければ、init-db の実行を促すエラーにする（起動時に呼ぶ。テーブルの作成・変更は行わない）
+def check_schema(engine):
+    version = schema_version(engine)
+    if version is None or version < len(MIGRATIONS):
+        raise RuntimeError(f"DBのスキーマが最新ではありません（バージョン: {version}、最新: {len(MIGRATIONS)}）。"
+                           "先に `flask --app app init-db` を実行してください。")
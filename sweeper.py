@@ -0,0 +1,89 @@
+# sweeper.py
+
+import logging
+import time
+from threading import Lock
+
+log = logging.getLogger('ss.sweeper')
+
+
+# 放置されたルーム、参照されなくなった画像、古い対応表などを少しずつ片付ける
+# ・一定間隔ごとに登録した処理（ステップ）を順に呼ぶ。各ステップは1回に batch 件までしか処理しない
+#   （続きは次回。前回の位置は next_page() / next_batch() で覚えておく）
+# ・DBのテーブルはキーの順に batch 件ずつ読み（next_page）、1回の処理でテーブル全体を読まない
+# ・ステップは片付けた件数を {種類: 件数} で返し、合計をメトリクスとログに出す
+# ・ルームの最終アクティビティ（作成・参加・めくりなど）を記録し、放置されたルームの判定に使う
+class Sweeper:
+    def __init__(self, interval=60.0, batch=100):
+        self.interval = interval
+        self.batch = batch
+        self._steps = []
+        self._activity = {}  # ルームID -> 最後のアクティビティの時刻（monotonic）
+        self._cursors = {}   # ステップ名 -> まだ処理していない項目、または前回の最後のキー
+        self._lock = Lock()
+        # メトリクス
+        self.passes = 0
+        self.reclaimed = {}  # 種類 -> 合計件数
+        self.last_pass = {}
+        self.last_duration = 0.0
+
+    def add_step(self, name, func):
+        self._steps.append((name, func))
+
+    # ルームで何かが起きたことを記録する（ロック不要の辞書への代入だけ）
+    def touch(self, room_id):
+        self._activity[room_id] = time.monotonic()
+
+    # 最後のアクティビティからの秒数。記録がなければ今から数え始める（再起動直後など）
+    def idle_for(self, room_id):
+        now = time.monotonic()
+        return now - self._activity.setdefault(room_id, now)
+
+    def forget(self, room_id):
+        self._activity.pop(room_id, None)
+
+    # 前回の最後のキーの次から batch 件を返す（load_page(前回の最後のキー, 件数) はキーの順に返す）
+    # 最後まで進んだら先頭に戻る
+    def next_page(self, name, load_page, batch):
+        items = load_page(self._cursors.get(name), batch)
+        self._cursors[name] = items[-1] if len(items) >= batch else None
+        return items
+
+    # メモリ上の一覧の前回の続きから batch 件を返す（最後まで進んだら load() で一覧を取り直す）
+    def next_batch(self, name, load, batch):
+        pending = self._cursors.get(name)
+        if not pending:
+            pending = self._cursors[name] = list(load())
+        items = pending[-batch:]
+        del pending[-batch:]
+        return items
+
+    def run_pass(self):
+        start = time.perf_counter()
+        reclaimed = {}
+        for name, func in self._steps:
+            try:
+                for kind, count in (func(self.batch) or {}).items():
+                    reclaimed[kind] = reclaimed.get(kind, 0) + count
+            except Exception:
+                log.exception('片付けの処理でエラーが発生しました: %s', name)
+        with self._lock:
+            self.passes += 1
+            for kind, count in reclaimed.items():
+                self.reclaimed[kind] = self.reclaimed.get(kind, 0) + count
+            self.last_pass = reclaimed
+            self.last_duration = time.perf_counter() - start
+        if any(reclaimed.values()):
+            log.info('片付けました: %s (%.3f 秒)', ', '.join(f"{kind}={count}" for kind, count in reclaimed.items() if count),
+                     self.last_duration)
+        return reclaimed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'passes': self.passes,
+                'reclaimed': dict(self.reclaimed),
+                'last_pass': dict(self.last_pass),
+                'last_duration': self.last_duration,
+                'tracked_rooms': len(self._activity),
+            }